@@ -0,0 +1,48 @@
+"""Time km_filter on a large synthetic KMP result.
+
+Run: python benchmarks/filter.py [rows]
+"""
+
+import sys
+from time import perf_counter
+from soliddriver_checks.api.filter import km_filter
+from soliddriver_checks.api.kmp import KMP_CHECKS, KMP_CATEGORIES
+from soliddriver_checks.api.results import flat_frame_builder, level_column
+
+FILTERS = [
+    '"vendor" = "Vendor 7"',
+    '"vendor.level" != "PASS"',
+    '"name" match "^foo-1[0-9]+-kmp" and "level.level" = "ERROR"',
+    '("vendor" = "Vendor 3" or "vendor" = "Vendor 5") and no "modalias"',
+]
+
+
+def make_frame(rows):
+    builder = flat_frame_builder(KMP_CHECKS, KMP_CATEGORIES)
+    for i in range(rows):
+        row = {"level": i % 3 + 1}
+        for c in KMP_CHECKS:
+            row[c] = f"{c}-{i}"
+            row[level_column(c)] = (i + len(c)) % 3 + 1
+        row["name"] = f"foo-{i}-kmp-default"
+        row["vendor"] = f"Vendor {i % 20}"
+        row["license"] = "GPL"
+        row["modalias"] = "" if i % 2 else "pci:v*"
+        builder.append(row)
+
+    return builder.build()
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    df = make_frame(rows)
+    for f in FILTERS:
+        km_filter(f, df)  # parse once
+        start = perf_counter()
+        matched = len(km_filter(f, df))
+        elapsed = perf_counter() - start
+        print(f"{elapsed * 1000:>8.1f} ms {matched:>8} rows  {f}")
+
+
+if __name__ == "__main__":
+    main()
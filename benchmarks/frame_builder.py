@@ -0,0 +1,67 @@
+"""Compare growing a DataFrame with pd.concat against ColumnarFrameBuilder.
+
+Run: python benchmarks/frame_builder.py [max_rows]
+
+The time per row of ColumnarFrameBuilder stays flat when the number of
+rows doubles (linear), the one of pd.concat keeps growing (quadratic).
+"""
+
+import sys
+from time import perf_counter
+import pandas as pd
+from soliddriver_checks.api.km import KM_CHECKS
+from soliddriver_checks.api.results import flat_columns, level_column
+from soliddriver_checks.api.utils.frame import ColumnarFrameBuilder
+
+KM_COLUMNS = flat_columns(KM_CHECKS)
+
+
+def make_row(i):
+    row = {"level": 1}
+    for c in KM_CHECKS:
+        row[c] = f"value-{i}"
+        row[level_column(c)] = 1
+    return row
+
+
+def with_concat(rows):
+    df = pd.DataFrame()
+    for row in rows:
+        df = pd.concat([df, pd.Series(row).to_frame().T], ignore_index=True)
+
+    return df
+
+
+def with_builder(rows):
+    builder = ColumnarFrameBuilder(KM_COLUMNS)
+    for row in rows:
+        builder.append(row)
+
+    return builder.build()
+
+
+def measure(func, rows):
+    start = perf_counter()
+    func(rows)
+    return perf_counter() - start
+
+
+def main():
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    print(
+        f"{'rows':>8} {'concat (s)':>12} {'us/row':>8} {'builder (s)':>12} {'us/row':>8}"
+    )
+    n = 1000
+    while n <= max_rows:
+        rows = [make_row(i) for i in range(n)]
+        concat = measure(with_concat, rows)
+        builder = measure(with_builder, rows)
+        print(
+            f"{n:>8} {concat:>12.3f} {concat / n * 1e6:>8.1f}"
+            f" {builder:>12.3f} {builder / n * 1e6:>8.1f}"
+        )
+        n *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Compare the modalias matching of a KMP with many device IDs.
+
+Run: python benchmarks/modalias.py [aliases]
+
+"fnmatch" is the previous implementation: every alias of the kernel
+modules is tried against every pattern of the KMP with fnmatch.fnmatch.
+"matcher" looks the aliases up in a ModaliasMatcher.
+"""
+
+import fnmatch
+import random
+import sys
+from time import perf_counter
+from soliddriver_checks.api.utils.modalias import ModaliasMatcher
+
+
+def make_aliases(count):
+    rng = random.Random(0)
+    aliases = []
+    for __ in range(count):
+        vendor, device = rng.getrandbits(16), rng.getrandbits(16)
+        aliases.append(
+            f"pci:v0000{vendor:04X}d0000{device:04X}sv*sd*bc*sc*i*",
+        )
+    # the KMP supplements are the module aliases, in another order
+    patterns = aliases[:]
+    rng.shuffle(patterns)
+
+    return aliases, patterns
+
+
+def with_fnmatch(aliases, patterns):
+    return [
+        next((i for i, p in enumerate(patterns) if fnmatch.fnmatch(a, p)), None)
+        for a in aliases
+    ]
+
+
+def with_matcher(aliases, patterns):
+    matcher = ModaliasMatcher(patterns)
+    return [matcher.match(a) for a in aliases]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    aliases, patterns = make_aliases(count)
+    print(f"{count} aliases, {count} patterns")
+
+    results = []
+    for name, func in (("fnmatch", with_fnmatch), ("matcher", with_matcher)):
+        start = perf_counter()
+        results.append(func(aliases, patterns))
+        print(f"{name:>12}: {perf_counter() - start:.3f}s")
+    assert results[0] == results[1]
+
+
+if __name__ == "__main__":
+    main()
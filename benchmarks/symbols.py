@@ -0,0 +1,86 @@
+"""Compare the symbol CRC checks of a synthetic KMP repository.
+
+Run: python benchmarks/symbols.py [modules] [modules_per_kmp]
+
+"per symbol" is the previous implementation: a dict lookup and two
+hex(int()) conversions for every symbol of every module. "batch" checks
+all the modules of the repository against their KMPs in one
+check_symbols call.
+"""
+
+import random
+import sys
+from time import perf_counter
+from soliddriver_checks.api.utils.symbols import check_symbols
+
+KERNEL_SYMBOLS = 30000
+SYMBOLS_PER_MODULE = 150
+
+
+def make_repo(modules, per_kmp):
+    rng = random.Random(0)
+    kernel = {f"sym_{i}": rng.getrandbits(32) for i in range(KERNEL_SYMBOLS)}
+    names = list(kernel)
+    repo = []
+    for __ in range(0, modules, per_kmp):
+        kms = []
+        reqs = {}
+        for __ in range(per_kmp):
+            syms = {s: kernel[s] for s in rng.sample(names, SYMBOLS_PER_MODULE)}
+            kms.append(syms)
+            reqs.update(syms)
+        # a few broken packages
+        for s in rng.sample(list(reqs), 3):
+            if rng.random() < 0.1:
+                del reqs[s]
+            elif rng.random() < 0.1:
+                reqs[s] ^= 1
+        repo.append((reqs, kms))
+
+    return repo
+
+
+def per_symbol(repo):
+    results = []
+    for reqs, kms in repo:
+        hex_reqs = {s: hex(c) for s, c in reqs.items()}
+        for syms in kms:
+            unfound = mismatched = 0
+            for sym, crc in syms.items():
+                chksum = hex(int("0x%08x" % crc, base=16))
+                req = hex_reqs.get(sym, None)
+                if req is None:
+                    unfound += 1
+                elif req != chksum:
+                    mismatched += 1
+            results.append((unfound, mismatched))
+
+    return results
+
+
+def batch(repo):
+    modules, requires, owners = [], [], []
+    for i, (reqs, kms) in enumerate(repo):
+        requires.append(reqs)
+        modules += kms
+        owners += [i] * len(kms)
+    unfound, mismatched = check_symbols(modules, requires, owners)
+
+    return list(zip(unfound.tolist(), mismatched.tolist()))
+
+
+def main():
+    modules = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    per_kmp = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    repo = make_repo(modules, per_kmp)
+    print(f"{len(repo)} KMPs, {modules} modules, {SYMBOLS_PER_MODULE} symbols each")
+
+    for name, func in (("per symbol", per_symbol), ("batch", batch)):
+        start = perf_counter()
+        result = func(repo)
+        print(f"{name:>12}: {perf_counter() - start:.3f}s")
+    assert per_symbol(repo) == batch(repo)
+
+
+if __name__ == "__main__":
+    main()
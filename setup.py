@@ -48,12 +48,16 @@ setup(
         "click>=8.1.3",
         "dominate>=2.7.0",
         "Jinja2>=3.1.2",
+        "numpy>=1.20.3",
         "openpyxl>=3.0.10",
         "pandas>=1.5.2",
         "rich>=12.6.0",
         "setuptools>=65.4.1",
         "requests>=2.28.1",
     ],
+    extras_require={
+        "zstd": ["zstandard>=0.19.0"],
+    },
     entry_points={
         "console_scripts": [
             "soliddriver-checks=soliddriver_checks.cli.cli:run",
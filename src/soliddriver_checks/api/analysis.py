@@ -1,50 +1,264 @@
-from .kmp import KMPReader, KMPAnalysis, analysis_kmps_to_dataframe
-from .km import KMReader, KMAnalysis
-from .filter import km_filter
+from .kmp import (
+    KMPReader,
+    KMPAnalysis,
+    analysis_kmps_to_dataframe,
+    analysis_kmp_to_row,
+    analysis_kmp_header_to_row,
+    KMP_CHECKS,
+)
+from .km import KMReader, KMAnalysis, KM_CHECKS
+from . import results
+from .filter import km_filter, compile_filter
+from .utils.timing import StageTimer
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import chain, islice
+import logging
+import os
 
+_checker = None
+# number of KMP headers read with concurrent rpm queries in one process.
+HEADER_BATCH = 32
+# KMPs handed to the worker processes ahead of the oldest one, per process.
+POOL_AHEAD = 4
+
+
+def _init_checker(kabi=None, modules_alias=None):
+    global _checker
+    _checker = (KMPReader(), KMPAnalysis(kabi, modules_alias))
+
+
+def _check_kmp(kmp, header=None, filter=None):
+    """Collect and analyse one KMP, in the current or a worker process.
+
+    Any failure is turned into an ERROR result of this KMP only. If the
+    header checks already show that the KMP can't match filter, its
+    payload is not read and the result is None.
+    """
+    if _checker is None:
+        _init_checker()
+    reader, anls = _checker
+    reader.timer = StageTimer()
+
+    try:
+        raw_info = reader.collect_kmp_header(kmp, header)
+        with reader.timer.stage("analysis"):
+            header_anls = anls.kmp_header_analysis(raw_info)
+        if filter:
+            row = analysis_kmp_header_to_row(header_anls)
+            if compile_filter(filter).evaluate(row) is False:
+                return None, reader.timer, False
+
+        reader.collect_kmp_modules(raw_info)
+        with reader.timer.stage("analysis"):
+            anls_info = anls.kmp_analysis(raw_info, header_anls)
+        failed = False
+    except Exception as e:
+        logging.exception("Check %s failed" % kmp)
+        anls_info = anls.kmp_failed_analysis(kmp, e)
+        failed = True
+
+    return anls_info, reader.timer, failed
+
+
+def _batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def _cached(kmp, cache):
+    """(key, cached result) of a KMP, (None, None) without cache."""
+    if cache is None:
+        return None, None
+
+    key = cache.key(kmp)
+    result = cache.get(key)
+    if result is not None:
+        # the same package may have been moved or copied.
+        result["path"]["value"] = kmp
+
+    return key, result
+
+
+def _store(cache, key, checked):
+    anls_info, __, failed = checked
+    if cache is not None and not failed and anls_info is not None:
+        cache.put(key, anls_info)
+
+    return checked
+
+
+def _resolve(cache, kmp, key, result):
+    if isinstance(result, Future):
+        return kmp, _store(cache, key, result.result())
+
+    return kmp, (result, StageTimer(), False)
+
+
+def _check_kmps(kmps, jobs, filter=None, kabi=None, modules_alias=None, cache=None):
+    """Yield (kmp, analysis) of every KMP of the kmps iterable, in input
+    order, with jobs processes.
+
+    kmps is consumed as the checks go, a few KMPs ahead only, so the first
+    results come before the walk is over. With a KMPResultCache, the
+    KMPs are looked up in it on the way and only the missing ones are
+    checked. The analysis is None for the KMPs skipped by filter, see
+    _check_kmp.
+    """
+    kmps = iter(kmps)
+    head = list(islice(kmps, 2))
+    kmps = chain(head, kmps)
+    if jobs == 1 or len(head) < 2:
+        _init_checker(kabi, modules_alias)
+        # overlap the rpm queries, the payloads are read one by one.
+        reader = KMPReader()
+        for batch in _batches(kmps, HEADER_BATCH):
+            lookups = [_cached(kmp, cache) for kmp in batch]
+            missed = [kmp for kmp, (__, res) in zip(batch, lookups) if res is None]
+            headers = {}
+            if len(missed) > 0:
+                headers = dict(zip(missed, reader.query_kmp_headers(missed)))
+            for kmp, (key, result) in zip(batch, lookups):
+                if result is not None:
+                    yield kmp, (result, StageTimer(), False)
+                    continue
+                anls_info, timer, failed = _check_kmp(kmp, headers[kmp], filter)
+                timer.merge(reader.timer)
+                reader.timer = StageTimer()
+                yield kmp, _store(cache, key, (anls_info, timer, failed))
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_checker, initargs=(kabi, modules_alias)
+    ) as pool:
+        # (kmp, key, cached result or future) of the KMPs on their way
+        window = deque()
+        for kmp in kmps:
+            key, result = _cached(kmp, cache)
+            if result is None:
+                result = pool.submit(_check_kmp, kmp, None, filter)
+            window.append((kmp, key, result))
+            while len(window) > jobs * POOL_AHEAD:
+                yield _resolve(cache, *window.popleft())
+        while window:
+            yield _resolve(cache, *window.popleft())
+
+
+def iter_kmp_results(
+    path,
+    proc_injector=None,
+    filter=None,
+    timer=None,
+    jobs=1,
+    cache=None,
+    walker=None,
+    kabi=None,
+    modules_alias=None,
+):
+    """Check all the KMPs under path, yield every result when it's ready.
+
+    jobs is the number of processes used for the checks, 0 means one per
+    CPU. The results are in the same order as with one process, the first
+    ones come while the KMPs are still being found. With a
+    KMPResultCache, unchanged KMPs are not checked again. walker is the
+    KMPFileWalker finding the KMPs, it's told about every KMP whose result
+    is yielded. Only the results matching filter are
+    yielded, progress is reported for all of them. The KMPs which can't
+    match filter by their header are not checked further, for them the
+    progress is reported with None. With a KABILibrary, the KABI
+    compatibility of every KMP is checked, with a ModulesAlias, the
+    devices its modules claim are looked up in the in-tree modules.
+    """
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
 
-def kmps_to_dataframe(path, proc_injector=None, filter=None):
     reader = KMPReader()
-    anls = KMPAnalysis()
-    kmps = reader.get_all_kmp_files(path)
+    kmps = reader.iter_kmp_files(path, walker)
     if proc_injector is not None:
-        proc_injector.prepartion(kmps)
+        # the KMPs are checked while they are found, their number is unknown
+        proc_injector.prepartion(None)
 
-    data = []
-    for kmp in kmps:
-        raw_info = reader.collect_kmp_data(kmp)
-        anls_info = anls.kmp_analysis(raw_info)
-        data.append(anls_info)
+    checked = _check_kmps(kmps, jobs, filter, kabi, modules_alias, cache)
+    for kmp, (anls_info, kmp_timer, failed) in checked:
+        if timer is not None:
+            timer.merge(kmp_timer)
         if proc_injector is not None:
             proc_injector.process(anls_info)
+        if anls_info is None:
+            continue
+        if filter:
+            row = analysis_kmp_to_row(anls_info)
+            if not compile_filter(filter).evaluate(row):
+                continue
+        if walker is not None and not failed:
+            walker.checked(kmp)
+        yield anls_info
 
     if proc_injector is not None:
         proc_injector.complete()
 
-    df = analysis_kmps_to_dataframe(data)
-    if filter is None:
-        return df
-    else:
-        return km_filter(filter, df)
+
+def kmps_to_dataframe(
+    path,
+    proc_injector=None,
+    filter=None,
+    timer=None,
+    jobs=1,
+    cache=None,
+    walker=None,
+    kabi=None,
+    modules_alias=None,
+):
+    """Check all the KMPs under path, see iter_kmp_results."""
+    data = iter_kmp_results(
+        path, proc_injector, filter, timer, jobs, cache, walker, kabi, modules_alias
+    )
+
+    return analysis_kmps_to_dataframe(data)
 
 
-def kmp_analysis(kmp_path):
+def kmp_analysis(kmp_path, kabi=None, modules_alias=None):
     reader = KMPReader()
-    anls = KMPAnalysis()
+    anls = KMPAnalysis(kabi, modules_alias)
 
     raw_info = reader.collect_kmp_data(kmp_path)
 
     return analysis_kmps_to_dataframe([anls.kmp_analysis(raw_info)])
 
 
-def kmps_to_json(path, proc_injector=None, filter=None):
-    df = kmps_to_dataframe(path, proc_injector, filter)
+def kmps_to_json(
+    path,
+    proc_injector=None,
+    filter=None,
+    jobs=1,
+    cache=None,
+    walker=None,
+    kabi=None,
+    modules_alias=None,
+):
+    df = kmps_to_dataframe(
+        path,
+        proc_injector,
+        filter,
+        jobs=jobs,
+        cache=cache,
+        walker=walker,
+        kabi=kabi,
+        modules_alias=modules_alias,
+    )
 
-    return df.to_json(orient="records")
+    return results.to_json(df, KMP_CHECKS)
 
 
-def kms_to_dataframe(filter=None):
-    reader = KMReader()
+def kms_to_dataframe(filter=None, jobs=1, cache=None):
+    """Check the modules of this system, jobs processes read the module
+    files, 0 means one per CPU. With a KMInfoCache, only the new or
+    changed modules are read."""
+    reader = KMReader(jobs=jobs, cache=cache)
     anls = KMAnalysis()
     df = anls.kms_analysis(reader.get_all_modinfo())
 
@@ -54,8 +268,8 @@ def kms_to_dataframe(filter=None):
         return km_filter(filter, df)
 
 
-def kms_to_json(df=None, filter=None):
+def kms_to_json(df=None, filter=None, cache=None):
     if df is None:
-        df = kms_to_dataframe(filter)
+        df = kms_to_dataframe(filter, cache=cache)
 
-    df.to_json(orient="records")
+    return results.to_json(df, KM_CHECKS)
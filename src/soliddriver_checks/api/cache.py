@@ -0,0 +1,420 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from ..config import SDCConf
+from ..version import __VERSION__
+from .utils.cmd import run_cmd
+from .utils.rpmfile import RPMFile, RPMFormatError, RPM_SIGNATURE_QUERYFORMAT
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# the rpm database of SLE 16 and openSUSE Tumbleweed, of older releases.
+RPMDB_DIRS = ["/usr/lib/sysimage/rpm", "/var/lib/rpm"]
+MODULES_DIRS = ("/lib/modules/", "/usr/lib/modules/")
+# one "@package, vendor, signature" line per package, then its files.
+RPM_OWNERSHIP_QUERY = (
+    "rpm -qa --qf '@%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}\\t%{VENDOR}\\t"
+    + RPM_SIGNATURE_QUERYFORMAT
+    + "\\n[%{FILENAMES}\\n]'"
+)
+
+
+def default_cache_dir():
+    cache_home = os.getenv("XDG_CACHE_HOME", None)
+    if cache_home is None:
+        cache_home = Path.home() / ".cache"
+
+    return Path(cache_home) / "soliddriver-checks"
+
+
+class KMPResultCache:
+    """On-disk cache of KMP check results.
+
+    A result is keyed by the SHA256 digest of the RPM header, the tool
+    version, the digest of the check policy and the ones of the KABI
+    library and the modules.alias, so a rebuilt package, a new release,
+    a policy change or another set of kernels never reuse an old result. The least
+    recently used results are evicted once the cache exceeds max_size
+    bytes. With refresh, cached results are ignored but replaced.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        max_size=DEFAULT_MAX_SIZE,
+        refresh=False,
+        kabi=None,
+        modules_alias=None,
+    ):
+        if path is None:
+            path = default_cache_dir() / "kmp-results.sqlite"
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite3.connect(str(path))
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS kmp_results ("
+            "key TEXT PRIMARY KEY, result TEXT, size INTEGER, last_used REAL)"
+        )
+        self._max_size = max_size
+        self._size = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM kmp_results"
+        ).fetchone()[0]
+        self._refresh = refresh
+        self._salt = f"{__VERSION__}:{SDCConf().get_policy_digest()}"
+        if kabi is not None:
+            self._salt += f":{kabi.digest}"
+        if modules_alias is not None:
+            self._salt += f":alias:{modules_alias.digest}"
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kmp_path):
+        """Cache key of a KMP, None if its header can't be read."""
+        try:
+            with RPMFile(kmp_path) as rpm:
+                digest = hashlib.sha256(rpm.header.raw).hexdigest()
+        except (OSError, RPMFormatError):
+            return None
+
+        return f"{digest}:{self._salt}"
+
+    def get(self, key):
+        if key is None or self._refresh:
+            self.misses += 1
+            return None
+
+        row = self._db.execute(
+            "SELECT result FROM kmp_results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self._db.execute(
+            "UPDATE kmp_results SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        self.hits += 1
+
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        if key is None:
+            return
+
+        value = json.dumps(result)
+        old = self._db.execute(
+            "SELECT size FROM kmp_results WHERE key = ?", (key,)
+        ).fetchone()
+        self._size += len(value) - (old[0] if old is not None else 0)
+        self._db.execute(
+            "INSERT OR REPLACE INTO kmp_results VALUES (?, ?, ?, ?)",
+            (key, value, len(value), time.time()),
+        )
+        self._evict()
+
+    def _evict(self):
+        if self._size <= self._max_size:
+            return
+
+        # make some room, not only for the next result.
+        rows = self._db.execute(
+            "SELECT key, size FROM kmp_results ORDER BY last_used"
+        ).fetchall()
+        evicted = []
+        for key, size in rows:
+            if self._size <= self._max_size * 0.9:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._db.executemany("DELETE FROM kmp_results WHERE key = ?", evicted)
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+class KMPFileIndex:
+    """(size, mtime, inode) of every KMP checked by the previous runs on a
+    directory, to tell new or changed KMPs apart from unchanged ones.
+
+    A KMP is only recorded once its result has been produced, see
+    checked(), so the KMPs whose check failed, was filtered out or didn't
+    run are found again by the next walk.
+    """
+
+    def __init__(self, root, path=None):
+        if path is None:
+            root_id = hashlib.sha256(os.path.abspath(root).encode()).hexdigest()
+            path = default_cache_dir() / f"kmp-index-{root_id[:16]}.json"
+        self._path = Path(path)
+        self._found = {}
+        try:
+            with open(self._path, "r") as fp:
+                self._entries = json.load(fp)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def changed(self, kmp_path, sig):
+        self._found[kmp_path] = sig
+        return self._entries.get(kmp_path, None) != sig
+
+    def checked(self, kmp_path):
+        """Record a KMP found by the walk as checked."""
+        sig = self._found.get(kmp_path, None)
+        if sig is not None:
+            self._entries[kmp_path] = sig
+
+    def save(self):
+        # KMPs which are gone are dropped from the index.
+        entries = {p: s for p, s in self._entries.items() if p in self._found}
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._path.with_suffix(".tmp")
+        with open(tmp, "w") as fp:
+            json.dump(entries, fp)
+        os.replace(tmp, self._path)
+        self._entries = entries
+        self._found = {}
+
+
+def rpmdb_stamp(dirs):
+    """mtime_ns of the files of the rpm database, which change with every
+    package installed, removed or updated."""
+    stamp = {}
+    for d in dirs:
+        d = os.path.realpath(d)
+        try:
+            entries = list(os.scandir(d))
+            stamp[d] = os.stat(d).st_mtime_ns
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                stamp[entry.path] = entry.stat().st_mtime_ns
+            except OSError:
+                pass
+
+    return stamp
+
+
+def _key_id(signature):
+    # RSA/SHA256, Wed 12 Oct 2022 06:57:49 PM CST, Key ID 70af9e8139db7c82
+    __, sep, key_id = signature.rpartition("Key ID ")
+    return key_id.strip() if sep else ""
+
+
+class RpmOwnershipIndex:
+    """{module file: (package, vendor, signature key ID)} of all the
+    packages installed, from one query of the rpm database.
+
+    The index is saved in the cache directory with the mtimes of the rpm
+    database files, it's only queried again when a package has been
+    installed, removed or updated since.
+    """
+
+    def __init__(self, owners):
+        self._owners = owners
+
+    @classmethod
+    def load(cls, path=None, rpmdb_dirs=RPMDB_DIRS):
+        if path is None:
+            path = default_cache_dir() / "rpm-ownership.json"
+        path = Path(path)
+        stamp = rpmdb_stamp(rpmdb_dirs)
+        try:
+            with open(path, "r") as fp:
+                saved = json.load(fp)
+            if saved["stamp"] == stamp:
+                return cls({f: tuple(o) for f, o in saved["owners"].items()})
+        except (OSError, ValueError, KeyError):
+            pass
+
+        index = cls.query()
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "w") as fp:
+                json.dump({"stamp": stamp, "owners": index._owners}, fp)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+        return index
+
+    @classmethod
+    def query(cls):
+        """Build the index from the rpm database, without the cache."""
+        owners = {}
+        package = None
+        for line in run_cmd(RPM_OWNERSHIP_QUERY).splitlines():
+            if line.startswith("@"):
+                name, vendor, signature = (line[1:].split("\t") + ["", ""])[:3]
+                if vendor == "(none)":
+                    vendor = ""
+                package = (name, vendor, _key_id(signature))
+            elif line.startswith(MODULES_DIRS) and package is not None:
+                owners[line] = package
+
+        return cls(owners)
+
+    def owner(self, path):
+        """(package, vendor, signature key ID) of a file, None if it's not
+        owned by any package.
+
+        Like rpm -qf, the file is also found by the real path of its
+        directory, /lib/modules may be a link to /usr/lib/modules.
+        """
+        owner = self._owners.get(path, None)
+        if owner is None:
+            real = os.path.join(
+                os.path.realpath(os.path.dirname(path)), os.path.basename(path)
+            )
+            owner = self._owners.get(real, None)
+
+        return owner
+
+
+def _km_compression(path):
+    # by the suffix, the content is not read for the signature.
+    for suffix, compression in ((".xz", "xz"), (".zst", "zstd"), (".gz", "gzip")):
+        if path.endswith(suffix):
+            return compression
+
+    return ""
+
+
+class KMInfoCache:
+    """On-disk cache of the modinfo fields of the modules of the system.
+
+    An entry is keyed by the path of a module file and only valid with
+    the same (inode, size, mtime_ns, compression) and tool version, so an
+    unchanged module costs one stat, a new or changed one is read again.
+    The entry also keeps the content digest used to find the identical
+    modules and the kernels the module can be weak-linked to, valid as
+    long as the symvers files are the same. The symbols of the modules
+    are kept apart, they are only read back when the kernels change.
+    With refresh, cached entries are ignored but replaced.
+    """
+
+    def __init__(self, path=None, refresh=False):
+        if path is None:
+            path = default_cache_dir() / "km-info.sqlite"
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite3.connect(str(path))
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS km_info ("
+            "path TEXT PRIMARY KEY, sig TEXT, digest TEXT, info TEXT, "
+            "kernels_stamp TEXT, kernels TEXT)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS km_symbols ("
+            "path TEXT PRIMARY KEY, sig TEXT, symbols TEXT)"
+        )
+        self._refresh = refresh
+        self._entries = None
+        self._dirty = set()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def signature(path, st):
+        return (
+            f"{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:"
+            f"{_km_compression(path)}:{__VERSION__}"
+        )
+
+    def _load(self):
+        if self._entries is None:
+            rows = self._db.execute(
+                "SELECT path, sig, digest, info, kernels_stamp, kernels FROM km_info"
+            )
+            self._entries = {path: entry for path, *entry in rows}
+
+        return self._entries
+
+    def _valid(self, path, st):
+        """The entry of path if it's still valid, None otherwise."""
+        entry = self._load().get(path, None)
+        if entry is None or entry[0] != self.signature(path, st):
+            return None
+
+        return entry
+
+    def _entry(self, path, st):
+        return None if self._refresh else self._valid(path, st)
+
+    def _update(self, path, st, **fields):
+        entry = self._valid(path, st)
+        if entry is None:
+            entry = [self.signature(path, st), None, None, None, None]
+            self._entries[path] = entry
+        for i, name in enumerate(("digest", "info", "kernels_stamp", "kernels"), 1):
+            if name in fields:
+                entry[i] = fields[name]
+        self._dirty.add(path)
+
+    def digest(self, path, st):
+        entry = self._entry(path, st)
+        return None if entry is None else entry[1]
+
+    def set_digest(self, path, st, digest):
+        self._update(path, st, digest=digest)
+
+    def get(self, path, st):
+        """The modinfo fields of a module, without its symbols."""
+        entry = self._entry(path, st)
+        if entry is None or entry[2] is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(entry[2])
+
+    def put(self, path, st, info):
+        info = dict(info)
+        symbols = info.pop("symbols", {})
+        self._update(path, st, info=json.dumps(info))
+        self._db.execute(
+            "INSERT OR REPLACE INTO km_symbols VALUES (?, ?, ?)",
+            (path, self.signature(path, st), json.dumps(symbols)),
+        )
+
+    def symbols(self, path, st):
+        row = self._db.execute(
+            "SELECT symbols FROM km_symbols WHERE path = ? AND sig = ?",
+            (path, self.signature(path, st)),
+        ).fetchone()
+
+        return {} if row is None else json.loads(row[0])
+
+    def kernels(self, path, st, stamp):
+        """{kernel release: compatible} of a module, None if it was
+        computed with other symvers files."""
+        entry = self._entry(path, st)
+        if entry is None or entry[3] != stamp:
+            return None
+
+        return json.loads(entry[4])
+
+    def set_kernels(self, path, st, stamp, kernels):
+        self._update(path, st, kernels_stamp=stamp, kernels=json.dumps(kernels))
+
+    def retain(self, paths):
+        """Drop the entries of the files which are gone."""
+        gone = [(p,) for p in self._load() if p not in paths]
+        for (path,) in gone:
+            del self._entries[path]
+            self._dirty.discard(path)
+        self._db.executemany("DELETE FROM km_info WHERE path = ?", gone)
+        self._db.executemany("DELETE FROM km_symbols WHERE path = ?", gone)
+
+    def close(self):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO km_info VALUES (?, ?, ?, ?, ?, ?)",
+            [(path, *self._entries[path]) for path in self._dirty],
+        )
+        self._dirty = set()
+        self._db.commit()
+        self._db.close()
@@ -1,17 +1,15 @@
-from lark import Lark, Transformer
+from functools import lru_cache
 import re
+from lark import Lark, Transformer
 import pandas as pd
-
+from .results import LEVEL_CODES, LEVEL_NAMES, LEVEL_SUFFIX
 
 grammar = r"""
-?start: expression
-expression: disjunction
-| conjunction
-| operation
-disjunction: conjunction ("or" conjunction)+ | conjunction
-conjunction: group ("and" group)+ | group
-group : "(" disjunction ")" | operation
-operation : nil | match | equal | notequal
+?start: disjunction
+?disjunction: conjunction ("or" conjunction)*
+?conjunction: group ("and" group)*
+?group : "(" disjunction ")" | operation
+?operation : nil | match | equal | notequal
 nil : "no" STRING
 match : STRING "match" STRING
 equal : STRING "=" STRING
@@ -22,247 +20,174 @@ notequal: STRING "!=" STRING
 %ignore WS
 """
 
+# LALR is built once, it's much faster than the default Earley parser.
+_parser = Lark(grammar, parser="lalr")
+
+
+def _unquote(token):
+    # remove '"' from left and right.
+    return str(token)[1:-1]
+
+
+def _column(field):
+    """Column of a filter key, "key.level" is the level of the check key
+    and "level.level" the row level."""
+    if field == "level" + LEVEL_SUFFIX:
+        return "level"
+
+    return field
+
+
+def _matching_levels(pattern):
+    """Codes of the levels whose name matches pattern, the level columns
+    hold the codes."""
+    return [
+        code for code, name in LEVEL_NAMES.items() if re.search(pattern, name)
+    ]
+
+
+class Operation:
+    """A comparison of one column, see grammar."""
+
+    def __init__(self, oper, field, value=""):
+        self.oper = oper
+        self.field = field
+        self.value = value
+
+    def _values(self, df):
+        column = df[_column(self.field)]
+        if self.field.endswith(LEVEL_SUFFIX):
+            return column, LEVEL_CODES.get(self.value, 0)
+
+        return column, self.value
+
+    def _compare(self, values, value):
+        if self.oper == "equal":
+            return values == value
+        elif self.oper == "ne":
+            return values != value
+        elif self.oper == "match":
+            return values.str.contains(value, regex=True, na=False)
+        elif self.oper == "no":
+            return values == ""
+
+    def mask(self, df):
+        column, value = self._values(df)
+        if self.oper == "match" and self.field.endswith(LEVEL_SUFFIX):
+            return column.isin(_matching_levels(self.value))
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            # compare the categories only, then pick by code.
+            categories = pd.Series(column.cat.categories.astype(str))
+            matched = self._compare(categories, value).fillna(False)
+            # code -1 is a missing value
+            return column.cat.codes.map(matched).fillna(False).astype(bool)
+        if not self.field.endswith(LEVEL_SUFFIX) and column.dtype == bool:
+            column = column.astype(str)  # "running" = "True"
+        elif self.oper == "match" and not pd.api.types.is_string_dtype(column):
+            column = column.astype(str)
+
+        return self._compare(column, value).fillna(False).astype(bool)
+
+    def evaluate(self, row):
+        """Evaluate on one row (a dict), None if the column is not known."""
+        column = _column(self.field)
+        if column not in row:
+            return None
+
+        value = row[column]
+        if self.oper == "match" and self.field.endswith(LEVEL_SUFFIX):
+            return value in _matching_levels(self.value)
+        if self.field.endswith(LEVEL_SUFFIX):
+            expected = LEVEL_CODES.get(self.value, 0)
+        else:
+            expected = self.value
+            if isinstance(value, bool):
+                value = str(value)
+
+        if self.oper == "equal":
+            return value == expected
+        elif self.oper == "ne":
+            return value != expected
+        elif self.oper == "match":
+            return value is not None and re.search(expected, str(value)) is not None
+        elif self.oper == "no":
+            return value == ""
+
+
+class Conjunction:
+    def __init__(self, operands):
+        self.operands = operands
+
+    def mask(self, df):
+        result = self.operands[0].mask(df)
+        for operand in self.operands[1:]:
+            result = result & operand.mask(df)
+
+        return result
+
+    def evaluate(self, row):
+        results = [operand.evaluate(row) for operand in self.operands]
+        if False in results:
+            return False
+        if None in results:
+            return None
+
+        return True
 
-class KernelModuleListFilter (Transformer):
-    def __init__(self):
-        super().__init__()
-        self.operators = []
+
+class Disjunction:
+    def __init__(self, operands):
+        self.operands = operands
+
+    def mask(self, df):
+        result = self.operands[0].mask(df)
+        for operand in self.operands[1:]:
+            result = result | operand.mask(df)
+
+        return result
+
+    def evaluate(self, row):
+        results = [operand.evaluate(row) for operand in self.operands]
+        if True in results:
+            return True
+        if None in results:
+            return None
+
+        return False
+
+
+class FilterCompiler(Transformer):
+    """Turn the parse tree into Operation, Conjunction and Disjunction."""
 
     def equal(self, vals):
-        val = "equal %s = %s" % (vals[0], vals[1])
-        self.operators.append(val)
+        return Operation("equal", _unquote(vals[0]), _unquote(vals[1]))
 
     def notequal(self, vals):
-        val = "ne %s = %s" % (vals[0], vals[1])
-        self.operators.append(val)
+        return Operation("ne", _unquote(vals[0]), _unquote(vals[1]))
 
     def match(self, vals):
-        val = "match %s = %s" % (vals[0], vals[1])
-        self.operators.append(val)
+        return Operation("match", _unquote(vals[0]), _unquote(vals[1]))
 
     def nil(self, vals):
-        val = "no %s" % vals[0]
-        self.operators.append(val)
+        return Operation("no", _unquote(vals[0]))
 
     def conjunction(self, vals):
-        if len(vals) > 1:
-            self.operators.append("and")
+        return Conjunction(vals)
 
     def disjunction(self, vals):
-        if len(vals) > 1:
-            self.operators.append("or")
+        return Disjunction(vals)
+
+
+@lru_cache(maxsize=64)
+def compile_filter(filter):
+    """Expression of a filter. mask(df) selects the rows of a result frame,
+    evaluate(row) tells whether a row matches: True, False, or None when
+    the row doesn't have all the columns yet."""
+    return FilterCompiler().transform(_parser.parse(filter))
 
 
 def km_filter(filter, data):
-    if filter == "":
+    if not filter:
         return data
 
-    parser = Lark(grammar)
-    kmf = KernelModuleListFilter()
-    tree = parser.parse(filter)
-    kmf.transform(tree)
-
-    return KM_filter(kmf.operators, data).process()
-
-
-class KM_filter:
-    def __init__(self, operators, data):
-        self._operators = operators
-        self.data = data.copy()
-
-    def _foramt_value(val: str):
-        val = val.strip()
-
-        # remove '"' from left and right.
-        return val[1:len(val)-1]
-
-    def _split_operator(operator: str):
-        if operator.startswith("equal"):
-            eq = operator[operator.find(" "):]
-            vals = eq.split("=")
-            flag, value = vals[0], "=".join(vals[1:])
-            return [
-                        "equal",
-                        KM_filter._foramt_value(flag),
-                        KM_filter._foramt_value(value)
-                    ]
-        if operator.startswith("ne"):
-            eq = operator[operator.find(" "):]
-            vals = eq.split("=")
-            flag, value = vals[0], "=".join(vals[1:])
-            return [
-                        "ne",
-                        KM_filter._foramt_value(flag),
-                        KM_filter._foramt_value(value)
-                    ]
-        elif operator.startswith("match"):
-            eq = operator[operator.find(" "):]
-            vals = eq.split("=")
-            flag, value = vals[0], "=".join(vals[1:])
-            return [
-                        "match",
-                        KM_filter._foramt_value(flag),
-                        KM_filter._foramt_value(value)
-                    ]
-        elif operator.startswith("no"):
-            flag = operator[operator.find(" "):]
-            return ["no", KM_filter._foramt_value(flag)]
-        elif operator == "and":
-            return ["and"]
-        elif operator == "or":
-            return ["or"]
-
-        # This should never happen.
-        return []
-
-    def _filter(field, oper, value, by_level=False, by_row_level=False):
-        if by_row_level:
-            field = field["level"]
-        elif by_level:
-            field = field["level"]["level"]
-        else:
-            field = field["value"]
-
-        if oper == 'equal':
-            if field == value:
-                return True
-            else:
-                return False
-        elif oper == 'ne':
-            if field != value:
-                return True
-            else:
-                return False
-        elif oper == 'match':
-            return re.search(value, field) is not None
-        elif oper == 'no':
-            if field == "":
-                return True
-            else:
-                return False
-
-    def _by_level(field):
-        """Check the search is for content or checking result.
-
-        Args:
-            field (str): if ended with ".level" means search for checking result.
-            otherwise for content.
-
-        Returns:
-            str, bool, bool: field, check field level, check row level.
-        """
-        if field.endswith(".level"):
-            field = field[:len(".level")-1]
-            if field == "level":
-                return field, True, True
-            else:
-                return field, True, False
-
-        return field, False, False
-
-    def _equal(field, value, df):
-        field, by_level, by_row_level = KM_filter._by_level(field)
-        return df.loc[df[f"{field}"].apply(
-                                            KM_filter._filter,
-                                            oper='equal',
-                                            value=value,
-                                            by_level=by_level,
-                                            by_row_level=by_row_level
-                                            )]
-
-    def _ne(field, value, df):
-        field, by_level, by_row_level = KM_filter._by_level(field)
-        return df.loc[df[f"{field}"].apply(
-                                            KM_filter._filter,
-                                            oper='ne',
-                                            value=value,
-                                            by_level=by_level,
-                                            by_row_level=by_row_level
-                                            )]
-
-    def _match(field, value, df):
-        return df.loc[df[f"{field}"].apply(
-                                            KM_filter._filter,
-                                            oper='match',
-                                            value=value
-                                            )]
-
-    def _no(field, df):
-        return df.loc[df[f"{field}"].apply(
-                                            KM_filter._filter,
-                                            oper='no',
-                                            value=""
-                                            )]
-
-    def _or(lval, rval):
-        pd.merge(lval, rval, how="outer")
-
-    def _and(lval, rval):
-        pd.merge(lval, rval, how="inner")
-
-    def process(self):
-        """
-        Rules (operation: eq, ne, nil, match): 
-         1. Operate with the original df if it's an operation.
-         2. Remove the operation once it's been used by 'and' or 'or' and save the result (dataframe) by rewriting the value of 'and' or 'or'
-         3. if the 'and' or 'or' is the last one but still have others in front, use it to do with the rest from end to front.
-        """
-
-        def _last_oper(procs):
-            for i in range(len(procs) - 1, -1, -1):
-                if procs[i] != "processed":
-                    return i
-            # This should never happend
-            return -1
-
-        last_oper = ""
-        proc_lst = []
-        opers = self._operators.copy()
-        for i in range(0, len(opers)):
-            oper = KM_filter._split_operator(opers[i])
-            if oper[0] == "equal":
-                df = KM_filter._equal(oper[1], oper[2], self.data)
-                proc_lst.append(df)
-            elif oper[0] == "ne":
-                df = KM_filter._ne(oper[1], oper[2], self.data)
-                proc_lst.append(df)
-            elif oper[0] == "match":
-                df = KM_filter._match(oper[1], oper[2], self.data)
-                proc_lst.append(df)
-            elif oper[0] == "no":
-                df = KM_filter._no(oper[1], self.data)
-                proc_lst.append(df)
-            elif oper[0] == "and":
-                last_oper = oper[0]
-                val_idx = _last_oper(proc_lst)
-                lval = proc_lst[val_idx]
-                proc_lst[val_idx] = "processed"
-                val_idx = _last_oper(proc_lst)
-                rval = proc_lst[val_idx]
-                proc_lst[val_idx] = "processed"
-                df = KM_filter._and(lval, rval)
-                proc_lst.append(df)
-            elif oper[0] == "or":
-                last_oper = oper[0]
-                val_idx = _last_oper(proc_lst)
-                lval = proc_lst[val_idx]
-                proc_lst[val_idx] = "processed"
-                val_idx = _last_oper(proc_lst)
-                rval = proc_lst[val_idx]
-                proc_lst[val_idx] = "processed"
-                df = KM_filter._or(lval, rval)
-                proc_lst.append(df)
-
-            last_val_idx = len(proc_lst) - 1
-            last_val = proc_lst[last_val_idx]
-            for i in range(len(proc_lst)-2, -1 , -1):
-                if proc_lst[i] != "processed":
-                    val_idx = _last_oper(proc_lst[:len(proc_lst)-2])
-                    val = proc_lst[val_idx]
-                    proc_lst[val_idx] = "processed"
-                    if last_oper == "and":
-                        proc_lst[last_val_idx] = KM_filter._and(last_val, val)
-                    elif last_oper == "or":
-                        proc_lst[last_val_idx] = KM_filter._or(last_val, val)
-
-        return proc_lst[last_val_idx]
+    return data[compile_filter(filter).mask(data)]
@@ -0,0 +1,366 @@
+import gzip
+import hashlib
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+from itertools import chain
+from pathlib import Path
+import numpy as np
+
+# /boot/symvers-<kernel release>.gz, a gzipped Module.symvers
+SYMVERS_FILE_RE = re.compile(r"^symvers-(.+)\.gz$")
+# written by "soliddriver-checks index-symvers" next to the symvers files
+SYMVERS_INDEX = "symvers.index"
+
+# magic, version, byte order, kernels, symbols, hash slots, the offsets of
+# the kernel names, symbol names, name offsets, hash slots, CRCs and
+# presence, and the library digest.
+_INDEX_HEADER = struct.Struct("<8sHHIII6Q64s")
+_INDEX_MAGIC = b"SDCKABI\0"
+_INDEX_VERSION = 1
+_BYTE_ORDER = {"little": 1, "big": 2}
+
+
+class KABIFormatError(Exception):
+    pass
+
+
+def kernel_flavor(release):
+    """Flavor of a kernel release: 5.14.21-150400.24.46-default -> default."""
+    parts = release.rsplit("-", 1)
+    if len(parts) < 2 or parts[1][:1].isdigit():
+        return None
+
+    return parts[1]
+
+
+def parse_symvers(data):
+    """{symbol: crc} of the content of a Module.symvers file.
+
+    Every line is: CRC, symbol, module, export type and an optional
+    namespace, separated by tabs.
+    """
+    symbols = {}
+    for line in data.splitlines():
+        fields = line.split(b"\t", 2)
+        if len(fields) < 2:
+            continue
+        try:
+            symbols[fields[1].decode()] = int(fields[0], 16) & 0xFFFFFFFF
+        except (ValueError, UnicodeDecodeError):
+            raise KABIFormatError("Invalid Module.symvers line: %r" % line)
+
+    return symbols
+
+
+def _symvers_files(path):
+    files = []
+    for f in sorted(Path(path).iterdir()):
+        m = SYMVERS_FILE_RE.match(f.name)
+        if m and f.is_file():
+            files.append((m.group(1), f))
+    if not files:
+        raise KABIFormatError("No symvers-*.gz file found in %s" % path)
+
+    return files
+
+
+def installed_symvers(modules_root="/lib/modules", boot="/boot"):
+    """(kernel release, symvers file) of the installed kernels, the
+    symvers.gz of the modules directory or /boot/symvers-<release>.gz."""
+    files = []
+    try:
+        releases = sorted(os.listdir(modules_root))
+    except OSError:
+        return files
+
+    for release in releases:
+        for f in (
+            Path(modules_root) / release / "symvers.gz",
+            Path(boot) / f"symvers-{release}.gz",
+        ):
+            if f.is_file():
+                files.append((release, f))
+                break
+
+    return files
+
+
+class SymbolHashTable:
+    """Symbol name -> ID lookups in the hash table of a symvers index.
+
+    Open addressing with linear probing, a slot holds ID + 1, 0 is free.
+    The symbols already looked up are remembered, KMPs mostly require the
+    same ones.
+    """
+
+    def __init__(self, names, offsets, slots):
+        self._names = names
+        self._offsets = offsets
+        self._slots = slots
+        self._mask = len(slots) - 1
+        self._seen = {}
+
+    def get(self, name, default=None):
+        sid = self._seen.get(name)
+        if sid is None:
+            sid = self._seen[name] = self._probe(name)
+
+        return default if sid < 0 else sid
+
+    def _probe(self, name):
+        key = name.encode()
+        i = zlib.crc32(key) & self._mask
+        while True:
+            sid = self._slots[i]
+            if sid == 0:
+                return -1
+            sid -= 1
+            if self._names[self._offsets[sid] : self._offsets[sid + 1]] == key:
+                return sid
+            i = (i + 1) & self._mask
+
+
+class KABILibrary:
+    """The KABI of a set of kernels, to find the kernels a KMP can run on.
+
+    All the symbols are interned into one table, every kernel is a row of
+    a (kernels x symbols) matrix of uint32 CRCs with a presence mask. The
+    library is loaded once and shared by all the KMP checks, a KMP is
+    checked against all the kernels with a few array operations.
+
+    Opened from a symvers index, the arrays are views of the mmap-ed file:
+    nothing is parsed or copied, and the worker processes, which reopen
+    the index, share the same pages.
+    """
+
+    def __init__(self, kernels, ids, crcs, present, digest, index=None):
+        self.kernels = kernels
+        self.flavors = [kernel_flavor(k) for k in kernels]
+        self._ids = ids
+        self._crcs = crcs
+        self._present = present
+        self.digest = digest
+        self._index = index
+
+    def __reduce_ex__(self, protocol):
+        if self._index is not None:
+            return (KABILibrary.open_index, (self._index,))
+
+        return super().__reduce_ex__(protocol)
+
+    @classmethod
+    def load(cls, path):
+        """Load all the symvers-<release>.gz files of a directory, from its
+        symvers index if it's up to date."""
+        files = _symvers_files(path)
+        index = Path(path) / SYMVERS_INDEX
+        try:
+            if index.stat().st_mtime >= max(f.stat().st_mtime for __, f in files):
+                library = cls.open_index(index)
+                if library.kernels == [release for release, __ in files]:
+                    return library
+        except (OSError, KABIFormatError):
+            pass
+
+        return cls.parse(files)
+
+    @classmethod
+    def parse(cls, files):
+        """Load a list of (kernel release, symvers-<release>.gz path)."""
+        digest = hashlib.sha256()
+        kernels, tables = [], []
+        for release, f in files:
+            raw = Path(f).read_bytes()
+            digest.update(release.encode() + b"\0" + raw)
+            kernels.append(release)
+            tables.append(parse_symvers(gzip.decompress(raw)))
+
+        return cls.from_symbols(kernels, tables, digest.hexdigest())
+
+    @classmethod
+    def from_symbols(cls, kernels, tables, digest):
+        """Build the library from one {symbol: crc} table per kernel."""
+        ids = {}
+        for table in tables:
+            for name in table:
+                ids.setdefault(name, len(ids))
+
+        crcs = np.zeros((len(kernels), len(ids)), dtype=np.uint32)
+        present = np.zeros((len(kernels), len(ids)), dtype=bool)
+        for row, table in enumerate(tables):
+            cols = np.fromiter((ids[n] for n in table), np.intp, len(table))
+            crcs[row, cols] = np.fromiter(table.values(), np.uint32, len(table))
+            present[row, cols] = True
+
+        return cls(kernels, ids, crcs, present, digest)
+
+    @classmethod
+    def open_index(cls, path):
+        """Open a file written by write_index."""
+        with open(path, "rb") as fp:
+            try:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise KABIFormatError("%s is not a symvers index" % path)
+        if len(mm) < _INDEX_HEADER.size:
+            raise KABIFormatError("%s is not a symvers index" % path)
+
+        header = _INDEX_HEADER.unpack_from(mm, 0)
+        magic, version, order, n_kernels, n_symbols, n_slots = header[:6]
+        kernels_off, names_off, offsets_off = header[6:9]
+        slots_off, crcs_off, present_off = header[9:12]
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+            raise KABIFormatError("%s is not a symvers index" % path)
+        if order != _BYTE_ORDER[sys.byteorder]:
+            raise KABIFormatError("%s was built on another architecture" % path)
+        if present_off + n_kernels * n_symbols > len(mm):
+            raise KABIFormatError("%s is truncated" % path)
+
+        view = memoryview(mm)
+        kernels = bytes(view[kernels_off:names_off]).rstrip(b"\0").decode()
+        offsets = view[offsets_off : offsets_off + (n_symbols + 1) * 4].cast("I")
+        ids = SymbolHashTable(
+            view[names_off:offsets_off],
+            offsets,
+            view[slots_off : slots_off + n_slots * 4].cast("I"),
+        )
+        shape = (n_kernels, n_symbols)
+        crcs = np.frombuffer(mm, np.uint32, n_kernels * n_symbols, crcs_off)
+        present = np.frombuffer(mm, bool, n_kernels * n_symbols, present_off)
+
+        return cls(
+            kernels.split("\n"),
+            ids,
+            crcs.reshape(shape),
+            present.reshape(shape),
+            header[12].decode(),
+            str(path),
+        )
+
+    def write_index(self, path):
+        """Write the library in the binary format of open_index.
+
+        Every section starts at an 8 bytes boundary, the integers are in
+        the byte order of this machine.
+        """
+        names = [n.encode() for n in self._symbol_names()]
+        offsets = np.zeros(len(names) + 1, np.uint32)
+        offsets[1:] = np.cumsum([len(n) for n in names])
+
+        n_slots = 1
+        while n_slots < 2 * len(names):
+            n_slots *= 2
+        slots = np.zeros(n_slots, np.uint32)
+        mask = n_slots - 1
+        for sid, name in enumerate(names):
+            i = zlib.crc32(name) & mask
+            while slots[i]:
+                i = (i + 1) & mask
+            slots[i] = sid + 1
+
+        sections = [
+            "\n".join(self.kernels).encode(),
+            b"".join(names),
+            offsets.tobytes(),
+            slots.tobytes(),
+            np.ascontiguousarray(self._crcs, np.uint32).tobytes(),
+            np.ascontiguousarray(self._present, bool).tobytes(),
+        ]
+        section_offsets = []
+        pos = _INDEX_HEADER.size
+        for section in sections:
+            pos += -pos % 8
+            section_offsets.append(pos)
+            pos += len(section)
+
+        header = _INDEX_HEADER.pack(
+            _INDEX_MAGIC,
+            _INDEX_VERSION,
+            _BYTE_ORDER[sys.byteorder],
+            len(self.kernels),
+            len(names),
+            n_slots,
+            *section_offsets,
+            self.digest.encode(),
+        )
+        tmp = Path(str(path) + ".tmp")
+        with open(tmp, "wb") as fp:
+            fp.write(header)
+            for offset, section in zip(section_offsets, sections):
+                fp.write(b"\0" * (offset - fp.tell()))
+                fp.write(section)
+        os.replace(tmp, path)
+
+    def _symbol_names(self):
+        if isinstance(self._ids, dict):
+            return list(self._ids)
+
+        offsets, names = self._ids._offsets, self._ids._names
+        return [
+            bytes(names[offsets[i] : offsets[i + 1]]).decode()
+            for i in range(len(offsets) - 1)
+        ]
+
+    def compatible_kernels(self, requires, flavors=None):
+        """Kernels providing all the {symbol: crc} requires of a KMP.
+
+        With flavors, only the kernels of these flavors are considered.
+        """
+        kernels = np.array(
+            [not flavors or f is None or f in flavors for f in self.flavors]
+        )
+        cols = np.fromiter(
+            (self._ids.get(n, -1) for n in requires), np.intp, len(requires)
+        )
+        if (cols < 0).any():  # not exported by any of the kernels
+            return []
+
+        crcs = np.fromiter(requires.values(), np.int64, len(requires))
+        crcs = (crcs & 0xFFFFFFFF).astype(np.uint32)
+        ok = self._present[:, cols].all(axis=1)
+        ok &= (self._crcs[:, cols] == crcs).all(axis=1)
+
+        return [k for k, match in zip(self.kernels, ok & kernels) if match]
+
+    def compatibility_matrix(self, requires):
+        """(len(requires) x kernels) bool matrix, whether every kernel
+        provides every {symbol: crc} of a list of requires.
+
+        All the requires are checked against all the kernels at once, the
+        failures are then counted per item with a cumulative sum.
+        """
+        sizes = np.array([len(r) for r in requires], dtype=np.intp)
+        total = int(sizes.sum())
+        cols = np.fromiter(
+            (self._ids.get(n, -1) for n in chain.from_iterable(requires)),
+            np.intp,
+            total,
+        )
+        crcs = np.fromiter(
+            chain.from_iterable(r.values() for r in requires), np.int64, total
+        )
+        crcs = (crcs & 0xFFFFFFFF).astype(np.uint32)
+
+        known = cols >= 0
+        cols = np.where(known, cols, 0)
+        ok = self._present[:, cols] & (self._crcs[:, cols] == crcs) & known
+
+        failures = np.zeros((len(self.kernels), total + 1), dtype=np.intp)
+        np.cumsum(~ok, axis=1, out=failures[:, 1:])
+        ends = np.cumsum(sizes)
+        failed = failures[:, ends] - failures[:, ends - sizes]
+
+        return (failed == 0).T
+
+
+def index_symvers(path):
+    """Compile the symvers-<release>.gz files of a directory into its
+    symvers index, return the path of the index."""
+    index = Path(path) / SYMVERS_INDEX
+    KABILibrary.parse(_symvers_files(path)).write_index(index)
+
+    return index
@@ -1,11 +1,30 @@
+import hashlib
 import os
-import pandas as pd
 import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 from ..config import SDCConf
 from enum import Enum, unique
-from .utils.cmd import run_cmd
+from .utils.weaklinks import scan_weak_updates
+from .cache import RpmOwnershipIndex
+from .kabi import KABILibrary, KABIFormatError, installed_symvers, kernel_flavor
+from .utils.kmfile import find_modules, loaded_modules, read_modinfo, read_modules_dep
+from .utils.modinfo import ModuleFormatError
+from .results import flat_frame_builder, from_nested_records, level_column
 import requests
 
+KM_CHECKS = [
+    "modulename",
+    "filename",
+    "license",
+    "signature",
+    "supported",
+    "running",
+    "kmp",
+    "kernel_compatibility",
+]
+KM_CATEGORIES = ["license"]
+
 
 @unique
 class KMEvaluation(Enum):
@@ -30,53 +49,46 @@ class KMAnalysis:
         self._valid_licenses = [i.get("name", "") for i in self._valid_licenses]
 
     def kms_analysis(self, kms):
-        row_level = []
-        df = pd.DataFrame()
+        builder = flat_frame_builder(KM_CHECKS, KM_CATEGORIES)
+        # the checks of the module content, done once for the paths of the
+        # same module_id, see KMReader.get_all_modinfo
+        content_checks = {}
         for filename in kms:
-            lev_name, name = self._km_module_name_analysis(
-                kms[filename].get("name", "")
-            )
-            row_level.append(lev_name["value"])
-            lev_fn, filename = self._km_filename_analysis(
-                filename, kms[filename].get("weak-updates", 0)
-            )
-            row_level.append(lev_fn["value"])
-            lev_spd, supported = self._km_supported_analysis(
-                kms[filename].get("supported", "")
-            )
-            row_level.append(lev_spd["value"])
-            lev_lic, license = self._km_license_analysis(
-                kms[filename].get("license", "")
-            )
-            row_level.append(lev_lic["value"])
-            lev_sig, signature = self._km_signature_analysis(
-                kms[filename].get("signature", "")
-            )
-            row_level.append(lev_sig["value"])
-            lev_r, running = self._km_running_analysis(kms[filename].get("running", ""))
-            row_level.append(lev_r["value"])
-            lev_kmp, kmp = self._km_kmp_analysis(kms[filename].get("kmp", None))
-            row_level.append(lev_kmp["value"])
-
-            row = pd.Series(
-                {
-                    "level": KMEvaluation(max(row_level)).to_json(),
-                    "modulename": {"level": lev_name, "value": name},
-                    "filename": {"level": lev_fn, "value": filename},
-                    "license": {"level": lev_lic, "value": license},
-                    "signature": {"level": lev_sig, "value": signature},
-                    "supported": {
-                        "level": lev_spd,
-                        "value": " ".join(supported).strip(),
-                    },
-                    "running": {"level": lev_r, "value": running},
-                    "kmp": {"level": lev_kmp, "value": kmp},
-                }
-            )
-
-            df = pd.concat([df, row.to_frame().T], ignore_index=True)
-
-        return df
+            km = kms[filename]
+            content = content_checks.get(km.get("module_id", None), None)
+            if content is None:
+                content = self._km_content_analysis(km)
+                if "module_id" in km:
+                    content_checks[km["module_id"]] = content
+            checks = {
+                **content,
+                "filename": self._km_filename_analysis(
+                    filename, km.get("weak-updates", 0)
+                ),
+                "running": self._km_running_analysis(km.get("running", "")),
+                "kmp": self._km_kmp_analysis(km.get("kmp", None)),
+                "kernel_compatibility": self._km_kernels_analysis(
+                    km.get("kernels", {})
+                ),
+            }
+
+            row = {}
+            for check, (level, value) in checks.items():
+                row[check] = value
+                row[level_column(check)] = level["value"]
+            row["supported"] = " ".join(row["supported"]).strip()
+            row["level"] = max(row[level_column(c)] for c in KM_CHECKS)
+            builder.append(row)
+
+        return builder.build()
+
+    def _km_content_analysis(self, km):
+        return {
+            "modulename": self._km_module_name_analysis(km.get("name", "")),
+            "license": self._km_license_analysis(km.get("license", "")),
+            "signature": self._km_signature_analysis(km.get("signature", "")),
+            "supported": self._km_supported_analysis(km.get("supported", "")),
+        }
 
     def _km_module_name_analysis(self, name):
         return KMEvaluation.PASS.to_json(), name
@@ -132,9 +144,19 @@ class KMAnalysis:
     def _km_running_analysis(self, running):
         return KMEvaluation.PASS.to_json(), running
 
+    def _km_kernels_analysis(self, kernels):
+        # only the updates/ and extra/ modules are checked.
+        value = ", ".join(
+            f"{k}: {'yes' if ok else 'no'}" for k, ok in sorted(kernels.items())
+        )
+        if all(kernels.values()):
+            return KMEvaluation.PASS.to_json(), value
+
+        return KMEvaluation.WARNING.to_json(), value
+
     def _km_kmp_analysis(self, kmp):
         if kmp is None:
-            return KMEvaluation.PASS.to_json(), {"name": "", "signature": ""}
+            return KMEvaluation.PASS.to_json(), ""
 
         name = kmp["name"]
         signature = kmp["signature"]
@@ -147,121 +169,347 @@ class KMAnalysis:
         return KMEvaluation.PASS.to_json(), name
 
 
+def _file_digest(filename):
+    digest = hashlib.sha256()
+    try:
+        with open(filename, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                digest.update(chunk)
+    except OSError:
+        # can't be compared, a group of its own
+        return filename
+
+    return digest.hexdigest()
+
+
+def _symvers_stamp(files):
+    """(release, path, size, mtime_ns) of the symvers files, to tell if
+    they changed."""
+    stamp = []
+    for release, f in files:
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        stamp.append((release, str(f), st.st_size, st.st_mtime_ns))
+
+    return json.dumps(stamp)
+
+
+def _exports_digest(exports):
+    """Digest of the {kernel tree: exported names} of the modules."""
+    digest = hashlib.sha256()
+    for tree, names in sorted(exports.items()):
+        digest.update(("\0".join([tree] + sorted(names)) + "\n").encode())
+
+    return digest.hexdigest()
+
+
+def _read_modinfo(filename):
+    """The fields of a module like modinfo prints them, {} if it's not a
+    valid module, a corrupt compressed one included: a bad module must not
+    stop the scan of all the others."""
+    try:
+        modinfo = read_modinfo(filename)
+    except (OSError, ModuleFormatError):
+        # read_modinfo raises the decompression errors as ModuleFormatError
+        return {}
+
+    info = {k: "\n".join(v) for k, v in modinfo.fields.items()}
+    info["symbols"] = modinfo.crcs
+    info["exports"] = modinfo.exports
+    if modinfo.signature:
+        info["sig_id"] = modinfo.sig_id
+        info["signer"] = modinfo.signer
+        info["sig_key"] = modinfo.sig_key
+        info["signature"] = modinfo.signature
+
+    return info
+
+
+def _read_modinfos(files):
+    return {filename: _read_modinfo(filename) for filename in files}
+
+
+def kernel_compatibility(value):
+    """{kernel release: bool} of a kernel_compatibility check value."""
+    kernels = {}
+    for item in value.split(", ") if value else []:
+        release, __, compatible = item.rpartition(": ")
+        kernels[release] = compatible == "yes"
+
+    return kernels
+
+
 class KMReader:
-    # resolve OSError: [Errno 7] Argument list too long: '/bin/sh'
-    def _split_cmd_args(self, files, cmd):
-        files_no = len(files)
-        output = ""
-        step = 300
-        for i in range(0, files_no, step):
-            curr_slip = step
-            if i + step > files_no:
-                curr_slip = files_no - i
-            str_files = " ".join(files[i : i + curr_slip])
-            output += run_cmd(cmd % str_files)
-
-        return output
+    def __init__(
+        self,
+        modules_root="/lib/modules",
+        proc_modules="/proc/modules",
+        owners=None,
+        boot="/boot",
+        jobs=1,
+        cache=None,
+    ):
+        self._modules_root = modules_root
+        self._proc_modules = proc_modules
+        self._owners = owners
+        self._boot = boot
+        self._jobs = jobs or os.cpu_count() or 1
+        self._cache = cache
+        self._stats = {}
 
     def get_all_modinfo(self):
-        running_kms = run_cmd(
-            "/usr/sbin/modinfo $(cat /proc/modules | awk '{print $1}') | grep filename | awk '{print$2}'"
-        ).splitlines()
-        # Have to remove the invalid running kernel module, like it's running inside container.
-        # But it always can't get rpm information if it's running inside container.
-        running_kms = [
-            file for file in running_kms if not file.startswith("modinfo: ERROR:")
-        ]
-        lm_kms = run_cmd(
-            'find /lib/modules/ -regex ".*\.\(ko\|ko.xz\|ko.zst\)$"'
-        ).splitlines()
-
-        files = list(set(running_kms + lm_kms))
-        # we don't need the entire signature, so add grep to ignore the details in other lines.
-        kms_info = self._split_cmd_args(
-            files, '/usr/sbin/modinfo %s | grep -E "^([a-z]|[A-Z])" 2>&1'
-        )
-        kms_info = kms_info.split("filename:")
-        if len(kms_info) == 0:
-            return {}
-
+        """{filename: modinfo fields} of all the modules of all the kernels
+        installed, and of the modules loaded in the running kernel.
+
+        The paths of the same module, hard links, links or identical
+        copies, are grouped: every distinct module is parsed once, in jobs
+        processes with the kernel trees split between them, and all its
+        paths get the same fields and module_id. The owners of the files
+        come from a RpmOwnershipIndex, the cached one by default. With a
+        KMInfoCache, only the new or changed modules are read, the others
+        are only stat'ed.
+        """
+        running_kms = set(self._running_module_files())
+        files = set(find_modules(self._modules_root)) | running_kms
+
+        self._stats = {}
+        for filename in files:
+            try:
+                self._stats[filename] = os.stat(filename)
+            except OSError:
+                continue
+
+        groups = self._group_identical(sorted(self._stats))
+        parsed = self._read_modules([paths[0] for paths in groups])
         kms = {}
-        kmps = self._split_cmd_args(files, "rpm -qf %s")
-        kmps = kmps.splitlines()
-        kmps_sig_pair = self._get_kmps_signature(kmps)
-        # Here's something needs to be take care of if you split all the modinfo output by "filename",
-        # If the kernel module is an invalid link, the output is:
-        # modinfo: ERROR: Module invalid-link.ko not found.
-        # If the kernel module is not a link but a broken kernel module, the output is:
-        # filename:       /full/path/to/broken.ko
-        # modinfo: ERROR: could not get modinfo from 'broken': Invalid argument
-        # so if you want to match the KMP search index with the modinfo output index, you have to
-        # take care of above. This is what I am doing.
-        kmp_index = 0
-        for km_info in kms_info[1:]:  # first one is empty.
-            lines = km_info.splitlines()
-            info = {}
-            filename = lines[0].strip()
-            for line in lines[
-                1:
-            ]:  # first line is filename, and filename is the key for info.
-                vs = line.split(":")
-                k, v = vs[0].strip(), ":".join(vs[1:]).strip()
-                if "modinfo" == k:  # invalid kernel module found
-                    if "not found." in v:  # invalid kernel module link found
-                        file = files[
-                            kmp_index
-                        ]  # the full file path only can be found in files. The orders are the same.
-                        kmps[file]["rpm"] = {"name": kmps[kmp_index], "signature": ""}
-                        kmp_index += 1
-                elif info.get(k, None) is not None:  # if already exist
-                    info[k] = info[k] + "\n" + v
-                else:
-                    info[k] = v
-            kms[filename] = info
-            kms[filename]["running"] = filename in running_kms
-            kms[filename]["kmp"] = {
-                "name": kmps[kmp_index],
-                "signature": kmps_sig_pair.get(kmps[kmp_index], ""),
-            }
-            kmp_index += 1
+        for paths in groups:
+            for filename in paths:
+                kms[filename] = dict(parsed[paths[0]], module_id=paths[0])
+        for filename in files:
+            # an invalid link
+            kms.setdefault(filename, {})
+        kms = dict(sorted(kms.items()))
+        for filename, info in kms.items():
+            info["running"] = filename in running_kms
+
+        owners = self._owners
+        if owners is None:
+            owners = RpmOwnershipIndex.load()
+        for filename, info in kms.items():
+            owner = owners.owner(filename)
+            if owner is None:
+                name = f"file {filename} is not owned by any package"
+                owner = (name, "", "")
+            info["kmp"] = dict(zip(("name", "vendor", "signature"), owner))
 
         self._check_weak_links(kms)
+        self._check_kernel_compatibility(kms)
+        if self._cache is not None:
+            self._cache.retain(self._stats)
 
         return kms
 
+    def update_running(self, kms):
+        """Update the running status of kms, as returned by
+        get_all_modinfo, to the modules loaded now. Return the files it
+        changed for, None if a loaded module is not in kms."""
+        running = set(self._running_module_files())
+        if not running <= kms.keys():
+            return None
+
+        changed = []
+        for filename, info in kms.items():
+            if info.get("running", False) != (filename in running):
+                info["running"] = filename in running
+                changed.append(filename)
+
+        return changed
+
+    def _running_module_files(self):
+        # the loaded modules without a file, like in a container, are ignored.
+        release = os.uname().release
+        try:
+            loaded = loaded_modules(self._proc_modules)
+            files = read_modules_dep(Path(self._modules_root) / release / "modules.dep")
+        except OSError:
+            return []
+
+        return [files[name] for name in loaded if name in files]
+
+    def _group_identical(self, files):
+        """Lists of the paths of the same module: the same (device, inode)
+        once the links are followed, or the same size and content."""
+        by_inode = {}
+        for filename in files:
+            st = self._stats[filename]
+            key = (st.st_dev, st.st_ino)
+            by_inode.setdefault(key, (st.st_size, []))[1].append(filename)
+
+        by_size = {}
+        for size, paths in by_inode.values():
+            by_size.setdefault(size, []).append(paths)
+
+        groups = []
+        for same_size in by_size.values():
+            if len(same_size) == 1:
+                groups += same_size
+                continue
+            by_digest = {}
+            for paths in same_size:
+                by_digest.setdefault(self._digest(paths[0]), []).extend(paths)
+            groups += [sorted(paths) for paths in by_digest.values()]
+
+        return groups
+
+    def _digest(self, filename):
+        if self._cache is None:
+            return _file_digest(filename)
+
+        st = self._stats[filename]
+        digest = self._cache.digest(filename, st)
+        if digest is None:
+            digest = _file_digest(filename)
+            self._cache.set_digest(filename, st, digest)
+
+        return digest
+
+    def _read_modules(self, files):
+        """{file: modinfo fields} of files, the cached ones or read with
+        one kernel tree per job."""
+        if self._cache is None:
+            return self._parse_modules(files)
+
+        parsed = {}
+        missed = []
+        for filename in files:
+            info = self._cache.get(filename, self._stats[filename])
+            if info is None:
+                missed.append(filename)
+            else:
+                parsed[filename] = info
+        for filename, info in self._parse_modules(missed).items():
+            self._cache.put(filename, self._stats[filename], info)
+            parsed[filename] = info
+
+        return parsed
+
+    def _parse_modules(self, files):
+        trees = {}
+        for filename in files:
+            try:
+                tree = Path(filename).relative_to(self._modules_root).parts[0]
+            except ValueError:
+                tree = None
+            trees.setdefault(tree, []).append(filename)
+
+        if self._jobs == 1 or len(trees) < 2:
+            return _read_modinfos(files)
+
+        parsed = {}
+        workers = min(self._jobs, len(trees))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for result in pool.map(_read_modinfos, trees.values()):
+                parsed.update(result)
+
+        return parsed
+
+    def _check_kernel_compatibility(self, kms):
+        """Find the installed kernels every updates/ and extra/ module can
+        be weak-linked to, like weak-modules2 does: the kernels of the
+        same flavor providing all the symbols of its __versions with the
+        same CRCs. The symbols exported by the updates/ and extra/ modules
+        of the same kernel tree, like the other modules of its KMP, are
+        provided too, they are linked along with it."""
+        modules = []
+        exports = {}
+        for filename in kms:
+            try:
+                parts = Path(filename).relative_to(self._modules_root).parts
+            except ValueError:
+                continue
+            # an unreadable module has no __versions to tell anything
+            if "vermagic" not in kms[filename]:
+                continue
+            if len(parts) > 2 and parts[1] in ("updates", "extra"):
+                modules.append((filename, parts[0], kernel_flavor(parts[0])))
+                provided = exports.setdefault(parts[0], set())
+                provided.update(kms[filename].get("exports", ()))
+        if len(modules) == 0:
+            return
+
+        files = installed_symvers(self._modules_root, self._boot)
+        if len(files) == 0:
+            return
+
+        # one row per distinct module and tree, the cached {tree: row} of a
+        # module is valid as long as the symvers files and the exports are
+        # the same.
+        trees = {}
+        for filename, tree, __ in modules:
+            module = kms[filename].get("module_id", filename)
+            trees.setdefault(module, set()).add(tree)
+        stamp = _symvers_stamp(files) + ":" + _exports_digest(exports)
+        rows = {}
+        symbols = {}
+        for module, module_trees in trees.items():
+            st = self._stats.get(module, None)
+            if self._cache is None or st is None:
+                symbols[module] = kms[module].get("symbols", {})
+                continue
+            cached = self._cache.kernels(module, st, stamp)
+            if cached is not None and module_trees <= cached.keys():
+                for tree in module_trees:
+                    rows[(module, tree)] = cached[tree]
+            elif "symbols" in kms[module]:
+                symbols[module] = kms[module]["symbols"]
+            else:
+                symbols[module] = self._cache.symbols(module, st)
+
+        library = None
+        if len(symbols) > 0:
+            try:
+                library = KABILibrary.parse(files)
+            except (OSError, KABIFormatError):
+                pass
+        if library is not None:
+            pending = [(m, t) for m in symbols for t in sorted(trees[m])]
+            requires = [
+                {n: crc for n, crc in symbols[m].items() if n not in exports[t]}
+                for m, t in pending
+            ]
+            matrix = library.compatibility_matrix(requires)
+            for key, row in zip(pending, matrix):
+                rows[key] = {k: bool(ok) for k, ok in zip(library.kernels, row)}
+            for module in symbols:
+                if self._cache is not None and module in self._stats:
+                    self._cache.set_kernels(
+                        module,
+                        self._stats[module],
+                        stamp,
+                        {t: rows[(module, t)] for t in trees[module]},
+                    )
+
+        for filename, tree, flavor in modules:
+            module = kms[filename].get("module_id", filename)
+            kernels = rows.get((module, tree), None)
+            if kernels is None:
+                continue
+            kms[filename]["kernels"] = {
+                k: ok
+                for k, ok in kernels.items()
+                if flavor is None or kernel_flavor(k) in (None, flavor)
+            }
+
     def _check_weak_links(self, kms):
-        pkg_path = os.path.dirname(__file__)
-        script = f"{pkg_path}/utils/scripts/check-links.sh"
-        j_links = run_cmd(script)
-        links = json.loads(j_links)
-        for km in links["weak-updates"]:
-            filename = km.get("km", None)
-            if filename is not None:
-                kms[filename]["weak-updates"] = km.get("status", 0)
-
-    def _get_kmps_signature(self, kmps):
-        uniq_kmps = set(kmps)
-        invalid_kmps = []
-        for kmp in uniq_kmps:
-            if kmp.endswith("is not owned by any package"):
-                invalid_kmps.append(kmp)
-        for ik in invalid_kmps:
-            uniq_kmps.remove(ik)
-        # example: Signature   : RSA/SHA256, Wed 12 Oct 2022 06:57:49 PM CST, Key ID 70af9e8139db7c82
-        signatures = run_cmd(
-            f'rpm -q --info {" ".join(uniq_kmps)} | grep -E "^Signature"'
-        ).splitlines()
-
-        kmp_sig_pairs = {}
-        uniq_kmps = list(uniq_kmps)
-        for i in range(0, len(uniq_kmps)):
-            kmp_sig_pairs[uniq_kmps[i]] = signatures[i].split(":")[1:]
-
-        return kmp_sig_pairs
+        for link in scan_weak_updates(self._modules_root):
+            km = kms.get(link.path, None)
+            if km is not None:
+                km["weak-updates"] = link.status
 
 
 def read_remote_json(url):
     response = requests.get(url)
-    df = pd.read_json(response.text)
 
-    return df
+    return from_nested_records(json.loads(response.text), KM_CHECKS, KM_CATEGORIES)
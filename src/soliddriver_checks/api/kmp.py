@@ -1,51 +1,114 @@
 from pathlib import Path
 import pandas as pd
 import re
-from collections import namedtuple
-import tempfile
-import fnmatch
+from collections import Counter
 from ..config import SDCConf
 from enum import Enum, unique
-from .utils.cmd import run_cmd
+from .utils.cmd import run_cmd, run_cmds
+from .utils.timing import StageTimer
+from .results import flat_frame_builder, flatten_record, level_column
+from .utils.walker import KMPFileWalker
+from .utils.symbols import check_symbols
+from .utils.modalias import ModaliasMatcher
+from .utils.rpmfile import RPMFile, RPMFormatError, RPM_SIGNATURE_QUERYFORMAT
+from .utils.modinfo import ModuleFormatError
+from .utils.kmfile import read_modinfo, is_kernel_module
+import shlex
+
+# All the header data collect_kmp_data needs, read by a single rpm query.
+# Every section starts with an "@tag@" line, multi-value tags follow it.
+_KMP_HEADER_QUERY = (
+    "@name@\n%{NAME}\n"
+    "@vendor@\n%{VENDOR}\n"
+    "@signature@\n" + RPM_SIGNATURE_QUERYFORMAT + "\n"
+    "@license@\n%{LICENSE}\n"
+    "@scripts@\n"
+    "%{PRETRANS}\n%{PREIN}\n%{POSTIN}\n%{PREUN}\n%{POSTUN}\n%{POSTTRANS}\n"
+    "@requires@\n[%{REQUIRENAME} %{REQUIREFLAGS:depflags} %{REQUIREVERSION}\n]"
+    "@supplements@\n[%{SUPPLEMENTNAME}\n]"
+)
+_KMP_HEADER_SECTION_RE = re.compile(
+    r"@(name|vendor|signature|license|scripts|requires|supplements)@"
+)
+# example: ksym(default:pci_enable_device) = 5fc1e7b3
+_KSYM_RE = re.compile(r"ksym\((.*):(.*)\) = (.+)")
+
+
+RAW_KMP_COLUMNS = [
+    "name",
+    "path",
+    "vendor",
+    "signature",
+    "license",
+    "wm2_invoked",
+    "km_info",
+]
+KMP_CHECKS = [
+    "name",
+    "path",
+    "vendor",
+    "signature",
+    "license",
+    "wm2_invoked",
+    "supported_flag",
+    "km_signatures",
+    "km_licenses",
+    "symbols",
+    "modalias",
+    "kabi_compatibility",
+    "alias_conflicts",
+]
+KMP_CATEGORIES = ["vendor", "license"]
+# the checks which only need the RPM header, see KMPAnalysis.kmp_header_analysis
+KMP_HEADER_CHECKS = ["name", "path", "vendor", "signature", "license"]
 
 
 def raw_kmp_to_series(data):
-    return pd.Series(
-        {
-            "name": data["name"],
-            "path": data["path"],
-            "vendor": data["vendor"],
-            "signature": data["signature"],
-            "license": data["license"],
-            "wm2_invoked": data["wm2_invoked"],
-            "km_info": data["km_info"],
-        }
-    )
+    return pd.Series({c: data[c] for c in RAW_KMP_COLUMNS})
 
 
-def analysis_kmps_to_dataframe(data):
-    df = pd.DataFrame()
+def analysis_kmp_to_record(item):
+    """One nested record of the KMP check result, from
+    KMPAnalysis.kmp_analysis."""
+    return {
+        "level": item["level"],
+        "name": item["name"],
+        "path": item["path"],
+        "vendor": item["vendor"],
+        "signature": item["signature"],
+        "license": item["license"],
+        "wm2_invoked": item["wm2_invoked"],
+        "supported_flag": item["km"]["supported"],
+        "km_signatures": item["km"]["signature"],
+        "km_licenses": item["km"]["license"],
+        "symbols": item["km"]["symbols"],
+        "modalias": item["km"]["alias"],
+        "kabi_compatibility": item["kabi_compatibility"],
+        "alias_conflicts": item["alias_conflicts"],
+    }
+
+
+def analysis_kmp_to_row(item):
+    """One flat row of the KMP check result, see results.py."""
+    return flatten_record(analysis_kmp_to_record(item), KMP_CHECKS)
+
+
+def analysis_kmp_header_to_row(item):
+    """The part of a flat row known from KMPAnalysis.kmp_header_analysis."""
+    row = {}
+    for check in KMP_HEADER_CHECKS:
+        row[check] = item[check]["value"]
+        row[level_column(check)] = item[check]["level"]["value"]
 
+    return row
+
+
+def analysis_kmps_to_dataframe(data):
+    builder = flat_frame_builder(KMP_CHECKS, KMP_CATEGORIES)
     for item in data:
-        new_row = pd.Series(
-            {
-                "level": item["level"],
-                "name": item["name"],
-                "path": item["path"],
-                "vendor": item["vendor"],
-                "signature": item["signature"],
-                "license": item["license"],
-                "wm2_invoked": item["wm2_invoked"],
-                "supported_flag": item["km"]["supported"],
-                "km_signatures": item["km"]["signature"],
-                "km_licenses": item["km"]["license"],
-                "symbols": item["km"]["symbols"],
-                "modalias": item["km"]["alias"],
-            }
-        )
-        df = pd.concat([df, new_row.to_frame().T], ignore_index=True)
+        builder.append(analysis_kmp_to_row(item))
 
-    return df
+    return builder.build()
 
 
 @unique
@@ -65,22 +128,39 @@ class KMPEvaluation(Enum):
 
 
 class KMPAnalysis:
-    def __init__(self):
+    def __init__(self, kabi=None, modules_alias=None):
         conf = SDCConf()
         self._valid_licenses = conf.get_valid_licenses()
+        self._kabi = kabi
+        self._modules_alias = modules_alias
 
-    def kmp_analysis(self, data):
-        ana_level = []
+    def kmp_header_analysis(self, data):
+        """Analysis of the checks which only need the RPM header."""
         name_lev, name_anls = self._kmp_name_analysis(data["name"])
-        ana_level.append(name_lev["value"])
         path_lev, path_anls = self._kmp_path_analysis(data["path"])
-        ana_level.append(path_lev["value"])
         ven_lev, vendor_anls = self._kmp_vendor_analysis(data["vendor"])
-        ana_level.append(ven_lev["value"])
         sig_lev, sig_anls = self._kmp_vendor_analysis(data["signature"])
-        ana_level.append(ven_lev["value"])
         lic_lev, license_anls = self._licenses_analysis([data["license"]])
-        ana_level.append(lic_lev["value"])
+
+        return {
+            "name": {"level": name_lev, "value": name_anls},
+            "path": {"level": path_lev, "value": path_anls},
+            "vendor": {"level": ven_lev, "value": vendor_anls},
+            "signature": {"level": sig_lev, "value": sig_anls},
+            "license": {"level": lic_lev, "value": license_anls},
+        }
+
+    def kmp_analysis(self, data, header_anls=None):
+        if header_anls is None:
+            header_anls = self.kmp_header_analysis(data)
+
+        ana_level = []
+        ana_level.append(header_anls["name"]["level"]["value"])
+        ana_level.append(header_anls["path"]["level"]["value"])
+        ana_level.append(header_anls["vendor"]["level"]["value"])
+        # the signature level has always been the one of the vendor.
+        ana_level.append(header_anls["vendor"]["level"]["value"])
+        ana_level.append(header_anls["license"]["level"]["value"])
         wm2_lev, wm2_invoked_anls = self._kmp_wm2_invoked_analysis(
             data["wm2_invoked"], data["name"]
         )
@@ -89,17 +169,46 @@ class KMPAnalysis:
             data["reqs"], data["modalias"], data["km_info"]
         )
         ana_level.append(km_lev["value"])
+        kabi_lev, kabi_anls = self._kmp_kabi_analysis(data["reqs"], data["flavors"])
+        ana_level.append(kabi_lev["value"])
+        conflict_lev, conflict_anls = self._kmp_alias_conflicts_analysis(
+            data["km_info"]
+        )
+        ana_level.append(conflict_lev["value"])
 
         row_eval = KMPEvaluation(max(ana_level))
         return {
             "level": row_eval.to_json(),
-            "name": {"level": name_lev, "value": name_anls},
-            "path": {"level": path_lev, "value": path_anls},
-            "vendor": {"level": ven_lev, "value": vendor_anls},
-            "signature": {"level": sig_lev, "value": sig_anls},
-            "license": {"level": lic_lev, "value": license_anls},
+            **header_anls,
             "wm2_invoked": {"level": wm2_lev, "value": wm2_invoked_anls},
             "km": km_anls,
+            "kabi_compatibility": {"level": kabi_lev, "value": kabi_anls},
+            "alias_conflicts": {"level": conflict_lev, "value": conflict_anls},
+        }
+
+    def kmp_failed_analysis(self, path, error):
+        """Analysis of a KMP which could not be checked at all."""
+        err = KMPEvaluation.ERROR.to_json()
+        msg = f"Check failed: {error}"
+        failed = {"level": err, "value": msg}
+
+        return {
+            "level": err,
+            "name": {"level": err, "value": Path(path).name},
+            "path": {"level": KMPEvaluation.PASS.to_json(), "value": path},
+            "vendor": failed,
+            "signature": failed,
+            "license": failed,
+            "wm2_invoked": failed,
+            "km": {
+                "license": failed,
+                "supported": failed,
+                "signature": failed,
+                "symbols": failed,
+                "alias": failed,
+            },
+            "kabi_compatibility": failed,
+            "alias_conflicts": failed,
         }
 
     def _kmp_name_analysis(self, name):
@@ -146,6 +255,37 @@ class KMPAnalysis:
 
         return KMPEvaluation.ERROR.to_json(), wm2
 
+    def _kmp_kabi_analysis(self, kmp_reqs, flavors):
+        if self._kabi is None:
+            return KMPEvaluation.PASS.to_json(), ""
+
+        kernels = self._kabi.compatible_kernels(kmp_reqs, flavors)
+        if len(kernels) == 0:
+            return KMPEvaluation.WARNING.to_json(), "No compatible kernel found"
+
+        return KMPEvaluation.PASS.to_json(), " ".join(kernels)
+
+    def _kmp_alias_conflicts_analysis(self, km_info):
+        if self._modules_alias is None:
+            return KMPEvaluation.PASS.to_json(), ""
+
+        conflicts = []
+        for km_path in km_info:
+            # an in-tree module of the same name is replaced, not a conflict
+            name = Path(km_path).name.split(".ko")[0].replace("-", "_")
+            for alias in km_info.get(km_path)["alias"]:
+                modules = [m for m in self._modules_alias.claims(alias) if m != name]
+                if modules:
+                    conflicts.append(
+                        f"{Path(km_path).name}: {alias.strip()} is also claimed by "
+                        + ", ".join(modules)
+                    )
+
+        if len(conflicts) == 0:
+            return KMPEvaluation.PASS.to_json(), "All passed"
+
+        return KMPEvaluation.WARNING.to_json(), "\n".join(conflicts)
+
     def _kmp_km_ana_summary(self, km_info, flavor):
         summary = {"level": KMPEvaluation.PASS.to_json(), "value": ""}
         values = []
@@ -166,7 +306,11 @@ class KMPAnalysis:
     def _kmp_km_analysis(self, kmp_reqs, kmp_modalias, km_info):
         km_analysis = {}
         ana_level = []
-        for km_path in km_info:
+        # the symbols of all the kernel modules are checked in one batch.
+        unfound, mismatched = check_symbols(
+            [km["symbols"] for km in km_info.values()], [kmp_reqs], [0] * len(km_info)
+        )
+        for i, km_path in enumerate(km_info):
             km_analysis[km_path] = {}
             eval, msg = self._licenses_analysis(km_info.get(km_path)["license"])
             km_analysis[km_path]["license"] = {"level": eval, "value": msg}
@@ -182,9 +326,7 @@ class KMPAnalysis:
             km_analysis[km_path]["signature"] = {"level": eval, "value": msg}
             ana_level.append(eval["value"])
 
-            eval, msg = self._kms_symbols_analysis(
-                kmp_reqs, km_info.get(km_path)["symbols"]
-            )
+            eval, msg = self._symbols_result(unfound[i], mismatched[i])
             km_analysis[km_path]["symbols"] = {"level": eval, "value": msg}
             ana_level.append(eval["value"])
 
@@ -201,26 +343,7 @@ class KMPAnalysis:
 
         return KMPEvaluation(max(ana_level)).to_json(), ana_summary
 
-    def _kms_symbols_analysis(self, kmp_reqs, km_syms):
-        syms = {}
-        syms["unfound"] = []
-        syms["checksum-mismatch"] = []
-        for sym in km_syms:
-            chksum = km_syms.get(sym)
-            chksum = hex(int(chksum, base=16))
-
-            req = kmp_reqs.get(sym, None)
-            if req is None:
-                syms["unfound"].append(sym)
-                continue
-
-            if req.checksum != chksum:
-                syms["checksum-mismatch"].append(
-                    "rpm checksum: %s, driver checksum: %s" % (chksum, req.checksum)
-                )
-
-        unfounded = len(syms["unfound"])
-        mismatched = len(syms["checksum-mismatch"])
+    def _symbols_result(self, unfounded, mismatched):
         if unfounded == 0 and mismatched == 0:
             return KMPEvaluation.PASS.to_json(), "All passed"
 
@@ -248,21 +371,24 @@ class KMPAnalysis:
             kms_alias += km_info.get(km_path)["alias"]
         kms_alias = set(kms_alias)
         unmatched_ker_alias = []
-        unmatched_kmp_alias = kmp_modalias.copy()
 
+        # every kernel alias takes one occurrence of the first pattern matching it
+        matcher = ModaliasMatcher(kmp_modalias)
+        matched = Counter()
         for ker_a in kms_alias:
             ker_a = ker_a.strip()
-            found = False
-            for kmp_a in kmp_modalias:
-                if fnmatch.fnmatch(ker_a.strip(), kmp_a.strip()):
-                    found = True
-                    for uk in unmatched_kmp_alias:
-                        if uk.strip() == kmp_a.strip():
-                            unmatched_kmp_alias.remove(uk)
-                            break
-                    break
-            if not found:
+            i = matcher.match(ker_a)
+            if i is None:
                 unmatched_ker_alias.append(ker_a)
+            else:
+                matched[matcher.patterns[i]] += 1
+
+        unmatched_kmp_alias = []
+        for kmp_a in kmp_modalias:
+            if matched[kmp_a.strip()] > 0:
+                matched[kmp_a.strip()] -= 1
+            else:
+                unmatched_kmp_alias.append(kmp_a)
 
         if len(unmatched_ker_alias) == 0 and len(unmatched_kmp_alias) == 0:
             return KMPEvaluation.PASS.to_json(), "All passed"
@@ -301,93 +427,62 @@ class KMPAnalysis:
 
 
 class KMPReader:
-    def get_all_kmp_files(self, path):
-        cmd = "find %s -regextype sed -regex '.*-kmp-.*\.rpm$'" % path
-        kmps = run_cmd(cmd)
+    def __init__(self, timer=None):
+        self.timer = timer if timer is not None else StageTimer()
 
-        return kmps.splitlines()
+    def iter_kmp_files(self, path, walker=None):
+        if walker is None:
+            walker = KMPFileWalker()
 
-    def collect_kmp_data(self, path):
-        base_info = self._get_kmp_info(path)
-        wm2_invoked = self._check_kmp_wm2_invoked(path)
-        reqs = self._get_kmp_requires(path)
-        modalias = self._get_kmp_modalias(path)
-        km_info = self._get_km_all_info(path)
+        yield from walker.walk(str(path))
 
-        return {
-            "name": base_info.get("Name", ""),
-            "path": path,
-            "vendor": base_info.get("Vendor", ""),
-            "signature": base_info.get("Signature", ""),
-            "license": base_info.get("License", ""),
-            "wm2_invoked": wm2_invoked,
-            "reqs": reqs,
-            "modalias": modalias,
-            "km_info": km_info,
-        }
+    def get_all_kmp_files(self, path, walker=None):
+        return list(self.iter_kmp_files(path, walker))
 
-    def _get_km_symbols(self, path):
-        cmd = "/usr/sbin/modprobe --dump-modversions %s" % path
-        symbols = run_cmd(cmd)
+    def collect_kmp_data(self, path, header=None):
+        return self.collect_kmp_modules(self.collect_kmp_header(path, header))
 
-        lines = symbols.splitlines()
-        symver = {}
-        for line in lines:
-            kv = line.split()
-            symver[kv[1]] = kv[0]
+    def collect_kmp_header(self, path, header=None):
+        """The KMP data from its RPM header, without km_info. A header read
+        by query_kmp_headers was timed there, once for the batch."""
+        if header is None:
+            with self.timer.stage("header"):
+                header = self._query_kmp_header(path)
 
-        return symver
-
-    def _get_km_supported_flag(self, path):
-        cmd = "/usr/sbin/modinfo --field=supported %s" % path
-        values = run_cmd(cmd)
-
-        return values.splitlines()
-
-    def _get_km_license(self, path):
-        cmd = "/usr/sbin/modinfo --field=license %s" % path
-        license = run_cmd(cmd)
-
-        return license.splitlines()
+        return {
+            "name": self._get_header_value(header, "name"),
+            "path": path,
+            "vendor": self._get_header_value(header, "vendor"),
+            "signature": self._get_header_value(header, "signature"),
+            "license": self._get_header_value(header, "license"),
+            "wm2_invoked": self._check_kmp_wm2_invoked(header.get("scripts", [])),
+            "reqs": self._get_kmp_requires(header.get("requires", [])),
+            "flavors": self._get_kmp_flavors(header.get("requires", [])),
+            "modalias": self._get_kmp_modalias(header.get("supplements", [])),
+        }
 
-    def _get_km_signature(self, path):
-        cmd = "/usr/sbin/modinfo --field=signature %s" % path
-        signature = run_cmd(cmd)
+    def collect_kmp_modules(self, data):
+        """Add km_info, read from the RPM payload, to collect_kmp_header."""
+        with self.timer.stage("modules"):
+            data["km_info"] = self._get_km_all_info(data["path"])
 
-        return signature
+        return data
 
-    def _get_km_alias(self, path):
-        alias = run_cmd("/usr/sbin/modinfo --field=alias %s | grep pci:" % path)
-        return alias.splitlines()
+    def _get_km_info(self, data):
+        return read_modinfo(data).to_km_info()
 
     def _get_km_all_info(self, rpm_path):
-        tmp = tempfile.TemporaryDirectory()
-
-        command = "rpm2cpio %s | cpio -idmv -D %s" % (rpm_path, tmp.name)
-        run_cmd(command)
-
-        rpm_dir = Path(tmp.name)
-        files = tuple(rpm_dir.rglob("*.*"))
-        kms = [i for i in files if re.search(r"\.(ko|ko\.xz)$", str(i))]
         result = dict()
 
-        if len(kms) < 1:
-            tmp.cleanup()
-            return result
-
-        for km in kms:
-            item = dict()
-            item["symbols"] = self._get_km_symbols(km)
-            item["supported"] = self._get_km_supported_flag(km)
-            item["license"] = self._get_km_license(km)
-            item["signature"] = self._get_km_signature(km)
-            item["alias"] = self._get_km_alias(km)
-
-            dpath = str(km)
-            dpath = dpath[dpath.startswith(tmp.name) + len(tmp.name) - 1 :]
-            result[dpath] = item
-
-        tmp.cleanup()
+        try:
+            with RPMFile(rpm_path) as rpm:
+                for dpath, data in rpm.iter_payload(is_kernel_module):
+                    try:
+                        result[dpath] = self._get_km_info(data)
+                    except ModuleFormatError as e:
+                        print(f"{dpath}: {e}")
+        except (OSError, RPMFormatError) as e:
+            print(e)
 
         return result
 
@@ -408,15 +503,44 @@ class KMPReader:
 
         return True, []
 
-    def _get_kmp_modalias(self, path):
-        cmd = "".join("rpm -q --nosignature --supplements %s" % path)
-        supplements = run_cmd(cmd)
+    def _kmp_header_cmd(self, path):
+        return "rpm -q --nosignature --queryformat %s %s" % (
+            shlex.quote(_KMP_HEADER_QUERY),
+            shlex.quote(str(path)),
+        )
 
-        success, err_info = self._check_kmp_manifest(supplements)
+    def _parse_kmp_header(self, output):
+        success, err_info = self._check_kmp_manifest(output)
         if not success:
             print(err_info)
-            return []
+            return {}
+
+        header = {}
+        section = None
+        for line in output.splitlines():
+            tag = _KMP_HEADER_SECTION_RE.fullmatch(line)
+            if tag:
+                section = tag.group(1)
+                header[section] = []
+            elif section is not None:
+                header[section].append(line)
+
+        return header
 
+    def _query_kmp_header(self, path):
+        return self._parse_kmp_header(run_cmd(self._kmp_header_cmd(path)))
+
+    def query_kmp_headers(self, paths):
+        """Read the headers of many KMPs with concurrent rpm queries."""
+        with self.timer.stage("header"):
+            outputs = run_cmds([self._kmp_header_cmd(p) for p in paths])
+
+        return [self._parse_kmp_header(o) for o in outputs]
+
+    def _get_header_value(self, header, tag):
+        return "\n".join(header.get(tag, [])).strip()
+
+    def _get_kmp_modalias(self, supplements):
         # modalias = namedtuple("modalias", "kernel_flavor pci_re")
         ml_pci_re = re.compile(
             r"modalias\((.*):(.*\:.*)\)"
@@ -426,7 +550,7 @@ class KMPReader:
         )  # example: packageand(kernel-default:primergy-be2iscsi)
 
         alias_re = []
-        for line in supplements.splitlines():
+        for line in supplements:
             pci_rst = ml_pci_re.match(line)
             all_rst = ml_all_re.match(line)
             if pci_rst:
@@ -440,17 +564,8 @@ class KMPReader:
 
         return alias_re
 
-    def _check_kmp_wm2_invoked(self, path):
-        cmd = "".join("rpm -q --nosignature --scripts %s" % path)
-        scripts = run_cmd(cmd)
-
-        success, err_info = self._check_kmp_manifest(scripts)
-        if not success:
-            print(err_info)
-            return False
-
-        lines = scripts.splitlines()
-        for line in lines:
+    def _check_kmp_wm2_invoked(self, scripts):
+        for line in scripts:
             if "/usr/lib/module-init-tools/weak-modules2" in line:
                 return True
             # Newer KMP scripts call kernel-scriptlets
@@ -459,44 +574,23 @@ class KMPReader:
 
         return False
 
-    def _get_kmp_requires(self, path):
-        cmd = "".join("rpm -q --nosignature --requires %s" % path)
-        requires = run_cmd(cmd)
+    def _get_kmp_flavors(self, requires):
+        """Kernel flavors of the ksym() requires."""
+        flavors = set()
+        for line in requires:
+            result = _KSYM_RE.match(line.strip())
+            if result:
+                flavors.add(result.group(1))
 
-        KernelSym = namedtuple("KernelSym", "kernel_flavor symbol checksum")
-        symver_re = re.compile(r"ksym\((.*):(.*)\) = (.+)")
-
-        success, err_info = self._check_kmp_manifest(requires)
-        if not success:
-            print(err_info)
-            return {}
+        return flavors
 
+    def _get_kmp_requires(self, requires):
+        """{symbol: crc} of the ksym() requires."""
         mod_reqs = {}
-        for line in requires.splitlines():
-            result = symver_re.match(line)
+        for line in requires:
+            result = _KSYM_RE.match(line.strip())
             if result:
-                flavor, sym, chksum = result.groups()
-                chksum = hex(int(chksum, base=16))
-                mod_reqs[sym] = KernelSym(
-                    kernel_flavor=flavor, symbol=sym, checksum=chksum
-                )
+                __, sym, chksum = result.groups()
+                mod_reqs[sym] = int(chksum, base=16)
 
         return mod_reqs
-
-    def _get_kmp_info(self, path):
-        cmd = "".join("rpm -q --nosignature --info %s" % path)
-        info = run_cmd(cmd)
-
-        success, err_info = self._check_kmp_manifest(info)
-        if not success:
-            print(err_info)
-            return {}
-
-        mod_info = {}
-        lines = info.splitlines()
-        for line in lines:
-            kv = line.split(":")
-            if len(kv) >= 2:
-                mod_info[kv[0].strip()] = ":".join(kv[1:]).strip()
-
-        return mod_info
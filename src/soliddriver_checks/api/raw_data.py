@@ -1,5 +1,5 @@
-import pandas as pd
-from .kmp import KMPReader, raw_kmp_to_series
+from .kmp import KMPReader, RAW_KMP_COLUMNS
+from .utils.frame import ColumnarFrameBuilder
 
 
 def kmps_to_dataframe(path, proc_injector=None):
@@ -8,18 +8,17 @@ def kmps_to_dataframe(path, proc_injector=None):
     if proc_injector is not None:
         proc_injector.prepartion(kmps)
 
-    df = pd.DataFrame()
+    builder = ColumnarFrameBuilder(RAW_KMP_COLUMNS)
     for kmp in kmps:
         raw_info = reader.collect_kmp_data(kmp)
-        row = raw_kmp_to_series(raw_info)
-        df = pd.concat([df, row.to_frame().T], ignore_index=True)
+        builder.append(raw_info)
         if proc_injector is not None:
             proc_injector.process_item(raw_info)
 
     if proc_injector is not None:
         proc_injector.complete()
 
-    return df
+    return builder.build()
 
 
 def kmps_to_json(path, proc_injector=None):
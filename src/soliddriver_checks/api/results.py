@@ -0,0 +1,102 @@
+"""Flat result model shared by the KMP and KM checks.
+
+Every check has a value column named after the check and an int8 level
+column named "<check>.level", the row level is the int8 "level" column.
+Levels are the values of KMPEvaluation/KMEvaluation: 1 PASS, 2 WARNING,
+3 ERROR. The nested JSON shape, where every cell is
+{"level": {"level": "PASS", "value": 1}, "value": ...}, is still used
+for JSON output and for reading remote results.
+"""
+
+import pandas as pd
+from .utils.frame import ColumnarFrameBuilder
+
+LEVEL_SUFFIX = ".level"
+LEVEL_NAMES = {1: "PASS", 2: "WARNING", 3: "ERROR"}
+LEVEL_CODES = {name: code for code, name in LEVEL_NAMES.items()}
+
+
+def level_column(check):
+    return check + LEVEL_SUFFIX
+
+
+def flat_columns(checks):
+    columns = ["level"]
+    for check in checks:
+        columns += [check, level_column(check)]
+
+    return columns
+
+
+def flat_dtypes(checks, categories=()):
+    dtypes = {"level": "int8"}
+    for check in checks:
+        dtypes[level_column(check)] = "int8"
+    for check in categories:
+        dtypes[check] = "category"
+
+    return dtypes
+
+
+def flat_frame_builder(checks, categories=()):
+    return ColumnarFrameBuilder(flat_columns(checks), flat_dtypes(checks, categories))
+
+
+def _nested_level(code):
+    return {"level": LEVEL_NAMES[code], "value": code}
+
+
+def flatten_record(record, checks):
+    """Flat row of a nested record. The checks it doesn't have, like the
+    ones added since a remote service release, PASS with an empty value."""
+    row = {"level": record["level"]["value"]}
+    for check in checks:
+        cell = record.get(check, {"level": _nested_level(1), "value": ""})
+        row[check] = cell["value"]
+        row[level_column(check)] = cell["level"]["value"]
+
+    return row
+
+
+def to_nested_records(df, checks):
+    """Nested records of a flat frame, for JSON output."""
+    records = []
+    for row in df.to_dict(orient="records"):
+        record = {"level": _nested_level(int(row["level"]))}
+        for check in checks:
+            record[check] = {
+                "level": _nested_level(int(row[level_column(check)])),
+                "value": row[check],
+            }
+        records.append(record)
+
+    return records
+
+
+def from_nested_records(records, checks, categories=()):
+    builder = flat_frame_builder(checks, categories)
+    for record in records:
+        builder.append(flatten_record(record, checks))
+
+    return builder.build()
+
+
+def value_frame(df, checks):
+    """Only the value columns of a flat frame."""
+    return df[list(checks)]
+
+
+def level_frame(df, checks):
+    """The level columns of a flat frame, named after their checks."""
+    levels = df[[level_column(c) for c in checks]]
+    levels.columns = list(checks)
+
+    return levels
+
+
+def records_to_json(records):
+    return pd.Series(records, dtype=object).to_json(orient="values")
+
+
+def to_json(df, checks):
+    return records_to_json(to_nested_records(df, checks))
@@ -1,4 +1,16 @@
+import asyncio
+import os
+import re
+import shlex
 import subprocess
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+# Upper limit of child processes running at the same time, for all the
+# commands started by AsyncCmdRunner in one event loop.
+MAX_CONCURRENT_CMDS = os.cpu_count() or 1
+
+_SHELL_CHARS = re.compile(r"[|&;<>()$`*?\[\]~{}\\\n]")
 
 
 def get_max_args():
@@ -43,14 +55,98 @@ def async_run_cmd(
                 break
 
 
+def _needs_shell(cmd):
+    # quoted strings are fine for shlex, everything else goes to the shell.
+    return _SHELL_CHARS.search(re.sub(r"'[^']*'", "", cmd)) is not None
+
+
+class AsyncCmdRunner:
+    """Run commands with asyncio, without a shell when they don't need one.
+
+    All the runners share one semaphore per event loop, so no more than
+    MAX_CONCURRENT_CMDS children run at the same time.
+    """
+
+    _semaphores = weakref.WeakKeyDictionary()
+
+    def __init__(self, timeout=None):
+        self._timeout = timeout
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        sem = AsyncCmdRunner._semaphores.get(loop, None)
+        if sem is None:
+            sem = asyncio.Semaphore(MAX_CONCURRENT_CMDS)
+            AsyncCmdRunner._semaphores[loop] = sem
+
+        return sem
+
+    async def run(self, cmd, timeout=None):
+        """Return stdout of cmd, a string or a list of arguments.
+
+        Raise subprocess.TimeoutExpired if it runs longer than timeout.
+        """
+        timeout = timeout if timeout is not None else self._timeout
+        async with self._semaphore():
+            if isinstance(cmd, str) and _needs_shell(cmd):
+                proc = await asyncio.create_subprocess_shell(
+                    cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                )
+            else:
+                args = shlex.split(cmd) if isinstance(cmd, str) else cmd
+                try:
+                    proc = await asyncio.create_subprocess_exec(
+                        *args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                    )
+                except FileNotFoundError:
+                    return ""
+
+            try:
+                result, __ = await asyncio.wait_for(proc.communicate(), timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise subprocess.TimeoutExpired(cmd, timeout)
+
+        return str(result, "utf-8")
+
+    async def run_all(self, cmds, timeout=None):
+        """Run cmds concurrently, the outputs are in the order of cmds."""
+        return await asyncio.gather(*(self.run(cmd, timeout) for cmd in cmds))
+
+
+def run_cmds(cmds, timeout=None):
+    """Run cmds concurrently with an AsyncCmdRunner and wait for them.
+
+    Async code may use the runner itself. When called with an event loop
+    running, the batch is run with its own loop in a worker thread.
+    """
+    batch = AsyncCmdRunner(timeout).run_all(cmds)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(batch)
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, batch).result()
+
+
 def run_cmd(cmd, sshClient=None, timeout=None):
     if sshClient is not None:
         __, stdout, __ = sshClient.exec_command(cmd, timeout=timeout)
         result = stdout.read()
         return str(result, "utf-8")
     else:
-        cmd_runner = subprocess.Popen(
-            cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        result, __ = cmd_runner.communicate()
-        return str(result, "utf-8")
+        # blocking, it may be called with an event loop running.
+        shell = _needs_shell(cmd)
+        try:
+            cmd_runner = subprocess.run(
+                cmd if shell else shlex.split(cmd),
+                shell=shell,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=timeout,
+            )
+        except FileNotFoundError:
+            return ""
+        return str(cmd_runner.stdout, "utf-8")
@@ -0,0 +1,27 @@
+import pandas as pd
+
+
+class ColumnarFrameBuilder:
+    """Collect rows column by column and create the DataFrame once.
+
+    Appending a row is O(1), unlike growing a DataFrame with pd.concat
+    which copies the whole frame for every row.
+    """
+
+    def __init__(self, columns, dtypes=None):
+        self._columns = {c: [] for c in columns}
+        self._dtypes = dtypes if dtypes is not None else {}
+
+    def __len__(self):
+        return len(next(iter(self._columns.values()), []))
+
+    def append(self, row):
+        for column, values in self._columns.items():
+            values.append(row[column])
+
+    def build(self):
+        df = pd.DataFrame(self._columns, columns=list(self._columns))
+        if self._dtypes:
+            df = df.astype(self._dtypes)
+
+        return df
@@ -0,0 +1,123 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+from collections import namedtuple
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# the changes of a directory tree: files added, removed, renamed or
+# rewritten, and the directory itself removed or renamed.
+IN_TREE_CHANGES = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+
+_EVENT = struct.Struct("iIII")
+
+InotifyEvent = namedtuple("InotifyEvent", ["wd", "mask", "cookie", "name"])
+
+
+class InotifyError(Exception):
+    pass
+
+
+def _libc():
+    name = ctypes.util.find_library("c")
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError) as e:
+        raise InotifyError("inotify is not available: %s" % e)
+
+    return libc
+
+
+class Inotify:
+    """Minimal inotify(7) binding, with ctypes to stay free of extra
+    dependencies. fileno() can be passed to select, read() returns the
+    pending events without blocking."""
+
+    def __init__(self):
+        self._libc = _libc()
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise InotifyError("inotify_init1: %s" % os.strerror(e))
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask):
+        """Watch descriptor of path, raise OSError if it can't be watched,
+        ENOSPC once fs.inotify.max_user_watches is reached."""
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), str(path))
+
+        return wd
+
+    def read(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append(InotifyEvent(wd, mask, cookie, os.fsdecode(name)))
+
+        return events
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def add_tree_watches(inotify, root, mask=IN_TREE_CHANGES):
+    """Watch root and all the directories under it, links aren't followed.
+
+    Return {watch descriptor: directory}. Raise OSError if a watch can't be
+    added for another reason than the directory being gone meanwhile.
+    """
+    watches = {}
+    for dirpath, __, __ in os.walk(root):
+        try:
+            wd = inotify.add_watch(dirpath, mask | IN_ONLYDIR | IN_DONT_FOLLOW)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                continue
+            raise
+        watches[wd] = dirpath
+
+    return watches
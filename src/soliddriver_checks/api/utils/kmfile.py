@@ -0,0 +1,133 @@
+import lzma
+import os
+import zlib
+from pathlib import Path
+from .modinfo import ModInfo, ModuleFormatError
+from .rpmfile import zstd
+
+KM_SUFFIXES = (".ko", ".ko.xz", ".ko.zst", ".ko.gz")
+
+XZ_MAGIC = b"\xfd7zXZ\x00"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+GZIP_MAGIC = b"\x1f\x8b"
+
+_READ_CHUNK = 64 * 1024
+# data following the end of the stream raises EOFError
+_DECOMPRESS_ERRORS = (lzma.LZMAError, zlib.error, EOFError)
+if zstd is not None:
+    _DECOMPRESS_ERRORS += (zstd.ZstdError,)
+
+
+def is_kernel_module(name):
+    return str(name).endswith(KM_SUFFIXES)
+
+
+def module_name(path):
+    """Name of a module file as the kernel knows it: foo-bar.ko.xz -> foo_bar."""
+    return Path(path).name.split(".ko")[0].replace("-", "_")
+
+
+def loaded_modules(proc="/proc/modules"):
+    """Names of the modules loaded in the running kernel."""
+    with open(proc) as fp:
+        return [line.split(" ", 1)[0] for line in fp if line.strip()]
+
+
+def read_modules_dep(path):
+    """{module name: file} of a modules.dep, the files resolved against
+    the directory of modules.dep like modprobe does."""
+    root = Path(path).parent
+    modules = {}
+    with open(path) as fp:
+        for line in fp:
+            file = line.split(":", 1)[0].strip()
+            if file:
+                modules.setdefault(module_name(file), str(root / file))
+
+    return modules
+
+
+def find_modules(root):
+    """Paths of the module files under root, symbolic links included but
+    not followed."""
+    for dirpath, __, filenames in os.walk(root):
+        for name in filenames:
+            if is_kernel_module(name):
+                yield os.path.join(dirpath, name)
+
+
+def detect_compression(head):
+    if head.startswith(XZ_MAGIC):
+        return "xz"
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+
+    return None
+
+
+def _decompressor(compression):
+    if compression == "xz":
+        return lzma.LZMADecompressor()
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=31)
+    if compression == "zstd":
+        if zstd is None:
+            raise ModuleFormatError("zstd module needs the 'zstandard' module")
+        decomp = zstd.ZstdDecompressor()
+        # zstandard decompresses a stream with a decompressobj, the
+        # ZstdDecompressor of compression.zstd is one itself.
+        if hasattr(decomp, "decompressobj"):
+            return decomp.decompressobj()
+        return decomp
+
+    raise ModuleFormatError("Unknown compression %s" % compression)
+
+
+def _chunks(source):
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as fp:
+            while True:
+                chunk = fp.read(_READ_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+    else:
+        view = memoryview(source)
+        for i in range(0, len(view), _READ_CHUNK):
+            yield view[i : i + _READ_CHUNK]
+
+
+def read_module(source):
+    """Return the uncompressed content of a kernel module.
+
+    source is a path or a buffer holding a .ko, .ko.xz, .ko.zst or .ko.gz,
+    the compression is detected from the content and it's inflated chunk
+    by chunk. The whole module is inflated, the signature is appended at
+    its end. A corrupt or truncated compressed module raises
+    ModuleFormatError.
+    """
+    chunks = _chunks(source)
+    head = next(chunks, b"")
+    compression = detect_compression(bytes(head[:6]))
+    if compression is None:
+        if not isinstance(source, (str, Path)):
+            return source
+        return bytes(head) + b"".join(chunks)
+
+    decomp = _decompressor(compression)
+    try:
+        data = bytearray(decomp.decompress(head))
+        for chunk in chunks:
+            data += decomp.decompress(chunk)
+    except _DECOMPRESS_ERRORS as e:
+        raise ModuleFormatError("Corrupt %s compressed module: %s" % (compression, e))
+    if not getattr(decomp, "eof", True):
+        raise ModuleFormatError("Truncated %s compressed module" % compression)
+
+    return bytes(data)
+
+
+def read_modinfo(source):
+    return ModInfo(read_module(source))
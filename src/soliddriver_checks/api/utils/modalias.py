@@ -0,0 +1,159 @@
+import fnmatch
+import hashlib
+import re
+from pathlib import Path
+
+_WILDCARDS = re.compile(r"[*?\[]")
+# pci:v<vendor>d<device>sv<subvendor>sd<subdevice>bc<class>sc<subclass>i<interface>
+# as written by modpost, every field is either an ID or "*".
+_PCI_ALIAS_RE = re.compile(
+    r"^pci:v([0-9A-F]{8}|\*)d([0-9A-F]{8}|\*)sv([0-9A-F]{8}|\*)sd([0-9A-F]{8}|\*)"
+    r"bc([0-9A-F]{2}|\*)sc([0-9A-F]{2}|\*)i([0-9A-F]{2}|\*)\*?$",
+    re.IGNORECASE,
+)
+
+
+def literal_prefix(pattern):
+    """The part of a glob pattern before its first wildcard."""
+    m = _WILDCARDS.search(pattern)
+    return pattern if m is None else pattern[: m.start()]
+
+
+class ModaliasMatcher:
+    """Find the first of a list of modalias glob patterns matching an alias.
+
+    The result is the one of trying fnmatch.fnmatch with every pattern in
+    order, but the patterns are compiled once and indexed by their literal
+    prefix: "pci:v000019A2d00000712sv*sd*bc*sc*i*" is only tried on the
+    aliases starting with "pci:v000019A2d00000712sv". An alias is looked
+    up once per distinct prefix length, then only the candidate patterns
+    are compiled and matched.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [p.strip() for p in patterns]
+        self._regexes = {}
+        self._by_prefix = {}
+        for i, pattern in enumerate(self.patterns):
+            prefix = literal_prefix(pattern)
+            prefixes = self._by_prefix.setdefault(len(prefix), {})
+            prefixes.setdefault(prefix, []).append(i)
+
+    def candidates(self, alias):
+        """Indexes of the patterns which may match alias, in order."""
+        found = []
+        for length, prefixes in self._by_prefix.items():
+            found += prefixes.get(alias[:length], ())
+
+        return sorted(found)
+
+    def match(self, alias):
+        """Index of the first pattern matching alias, None if none does."""
+        for i in self.candidates(alias):
+            if self._match(i, alias):
+                return i
+
+        return None
+
+    def _match(self, i, alias):
+        pattern = self.patterns[i]
+        # "*" and "?" match themselves, a "[...]" set doesn't
+        if alias == pattern and "[" not in pattern:
+            return True
+
+        regex = self._regexes.get(pattern)
+        if regex is None:
+            regex = self._regexes[pattern] = re.compile(fnmatch.translate(pattern))
+
+        return regex.match(alias) is not None
+
+    def matches(self, alias):
+        """Indexes of all the patterns matching alias."""
+        return [i for i in self.candidates(alias) if self._match(i, alias)]
+
+
+def parse_pci_alias(alias):
+    """The 7 fields of a PCI modalias, None if it's not one."""
+    m = _PCI_ALIAS_RE.match(alias)
+    if m is None:
+        return None
+
+    return tuple(f.upper() for f in m.groups())
+
+
+def _fields_overlap(a, b):
+    """Whether two tuples of PCI alias fields can match the same device."""
+    return all(x == y or x == "*" or y == "*" for x, y in zip(a, b))
+
+
+class ModulesAlias:
+    """The modules.alias of a kernel, indexed to find the modules claiming
+    the devices of a modalias.
+
+    The PCI aliases are indexed by (vendor, device): only the aliases with
+    the same IDs or a wildcard are compared, field by field. Any other
+    alias is claimed by the patterns matching it, looked up with a
+    ModaliasMatcher.
+    """
+
+    def __init__(self, entries, digest, path=None):
+        self.digest = digest
+        self._path = path
+        self._pci = {}
+        others = []
+        for pattern, module in entries:
+            fields = parse_pci_alias(pattern)
+            if fields is None:
+                others.append((pattern, module))
+            else:
+                self._pci.setdefault(fields[:2], []).append((fields[2:], module))
+        self._others = ModaliasMatcher(p for p, __ in others)
+        self._other_modules = [m for __, m in others]
+
+    def __reduce_ex__(self, protocol):
+        if self._path is not None:
+            return (ModulesAlias.load, (self._path,))
+
+        return super().__reduce_ex__(protocol)
+
+    @classmethod
+    def load(cls, path):
+        """Load a modules.alias file, as written by depmod."""
+        raw = Path(path).read_bytes()
+        entries = []
+        for line in raw.decode(errors="replace").splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[0] == "alias":
+                entries.append((fields[1], fields[2]))
+
+        return cls(entries, hashlib.sha256(raw).hexdigest(), str(path))
+
+    @classmethod
+    def for_kernel(cls, release, root="/lib/modules"):
+        """Load the modules.alias of an installed kernel."""
+        return cls.load(Path(root) / release / "modules.alias")
+
+    def claims(self, alias):
+        """Sorted names of the modules claiming a device of alias."""
+        alias = alias.strip()
+        modules = set()
+        fields = parse_pci_alias(alias)
+        if fields is not None:
+            for rest, module in self._pci_candidates(fields[0], fields[1]):
+                if _fields_overlap(rest, fields[2:]):
+                    modules.add(module)
+
+        for i in self._others.matches(alias):
+            modules.add(self._other_modules[i])
+
+        return sorted(modules)
+
+    def _pci_candidates(self, vendor, device):
+        if vendor == "*" or device == "*":
+            # rare and always a bad idea, compare with all the IDs
+            keys = [k for k in self._pci if _fields_overlap(k, (vendor, device))]
+        else:
+            keys = [(vendor, device), (vendor, "*"), ("*", device), ("*", "*")]
+
+        for key in keys:
+            yield from self._pci.get(key, ())
@@ -0,0 +1,164 @@
+import struct
+from pathlib import Path
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+# struct modversion_info { unsigned long crc; char name[64 - sizeof(long)]; }
+MODVERSION_INFO_SIZE = 64
+
+MODULE_SIG_MAGIC = b"~Module signature appended~\n"
+# struct module_signature: algo, hash, id_type, signer_len, key_id_len,
+# __pad[3], __be32 sig_len
+MODULE_SIG_INFO_SIZE = 12
+PKEY_ID_PKCS7 = 2
+
+_PARSED_SECTIONS = (b".modinfo", b"__versions", b"__ksymtab_strings")
+
+
+class ModuleFormatError(Exception):
+    pass
+
+
+class ModInfo:
+    """Metadata of a kernel module read from its ELF sections.
+
+    The module is parsed once, from a file or from a memory buffer, the
+    result has the same content as modinfo and modprobe --dump-modversions.
+    """
+
+    def __init__(self, data):
+        if isinstance(data, (str, Path)):
+            data = Path(data).read_bytes()
+
+        self._data = memoryview(data)
+        self.fields = {}
+        self.crcs = {}
+        # names of the symbols the module exports
+        self.exports = []
+        self.signature = ""
+        self.signer = ""
+        self.sig_key = ""
+        self.sig_id = ""
+
+        self._parse_sections()
+        self._parse_signature()
+
+    def get(self, key):
+        return self.fields.get(key, [])
+
+    @property
+    def symbols(self):
+        """Symbol CRCs formatted like modprobe --dump-modversions."""
+        return {name: "0x%08x" % crc for name, crc in self.crcs.items()}
+
+    def to_km_info(self):
+        """The shape KMPAnalysis._kmp_km_analysis expects for a module,
+        symbols are {name: crc}."""
+        return {
+            "symbols": self.crcs,
+            "supported": self.get("supported"),
+            "license": self.get("license"),
+            "signature": self.signature,
+            "alias": [a for a in self.get("alias") if "pci:" in a],
+        }
+
+    def _parse_sections(self):
+        data = self._data
+        if len(data) < 64 or data[:4] != ELF_MAGIC:
+            raise ModuleFormatError("Not an ELF file")
+
+        elf_class, elf_data = data[4], data[5]
+        if elf_data == ELFDATA2LSB:
+            endian = "<"
+        elif elf_data == ELFDATA2MSB:
+            endian = ">"
+        else:
+            raise ModuleFormatError("Unknown ELF data encoding %d" % elf_data)
+
+        if elf_class == ELFCLASS64:
+            shoff = struct.unpack_from(endian + "Q", data, 0x28)[0]
+            shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x3A)
+            sh_fmt = endian + "IIQQQQ"
+            crc_fmt = endian + "Q"
+        elif elf_class == ELFCLASS32:
+            shoff = struct.unpack_from(endian + "I", data, 0x20)[0]
+            shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x2E)
+            sh_fmt = endian + "IIIIII"
+            crc_fmt = endian + "I"
+        else:
+            raise ModuleFormatError("Unknown ELF class %d" % elf_class)
+
+        if shoff + shnum * shentsize > len(data) or shstrndx >= shnum:
+            raise ModuleFormatError("Truncated ELF section header table")
+
+        sections = []
+        for i in range(shnum):
+            name, __, __, __, offset, size = struct.unpack_from(
+                sh_fmt, data, shoff + i * shentsize
+            )
+            sections.append((name, offset, size))
+
+        __, str_offset, str_size = sections[shstrndx]
+        shstrtab = bytes(data[str_offset : str_offset + str_size])
+        for name, offset, size in sections:
+            end = shstrtab.find(b"\0", name)
+            section = shstrtab[name:end]
+            if section in _PARSED_SECTIONS and offset + size > len(data):
+                raise ModuleFormatError("Truncated section %s" % section.decode())
+            if section == b".modinfo":
+                self._parse_modinfo(data[offset : offset + size])
+            elif section == b"__versions":
+                self._parse_versions(data[offset : offset + size], crc_fmt)
+            elif section == b"__ksymtab_strings":
+                self._parse_exports(data[offset : offset + size])
+
+    def _parse_modinfo(self, section):
+        for item in bytes(section).split(b"\0"):
+            if b"=" not in item:
+                continue
+            key, value = item.decode("utf-8", "replace").split("=", 1)
+            self.fields.setdefault(key, []).append(value)
+
+    def _parse_exports(self, section):
+        # the symbol namespaces are there too, they don't match any name
+        for name in bytes(section).split(b"\0"):
+            if name:
+                self.exports.append(name.decode("utf-8", "replace"))
+
+    def _parse_versions(self, section, crc_fmt):
+        crc_size = struct.calcsize(crc_fmt)
+        for offset in range(
+            0, len(section) - MODVERSION_INFO_SIZE + 1, MODVERSION_INFO_SIZE
+        ):
+            crc = struct.unpack_from(crc_fmt, section, offset)[0]
+            name = bytes(section[offset + crc_size : offset + MODVERSION_INFO_SIZE])
+            name = name.split(b"\0", 1)[0].decode("utf-8", "replace")
+            self.crcs[name] = crc & 0xFFFFFFFF
+
+    def _parse_signature(self):
+        data = self._data
+        magic_len = len(MODULE_SIG_MAGIC)
+        if bytes(data[-magic_len:]) != MODULE_SIG_MAGIC:
+            return
+
+        end = len(data) - magic_len - MODULE_SIG_INFO_SIZE
+        if end < 0:
+            return
+        __, __, id_type, signer_len, key_id_len, sig_len = struct.unpack_from(
+            ">BBBBB3xI", data, end
+        )
+        sig_start = end - sig_len
+        key_start = sig_start - key_id_len
+        signer_start = key_start - signer_len
+        if signer_start < 0:
+            return
+
+        signature = bytes(data[sig_start:end])
+        self.signature = ":".join("%02X" % b for b in signature)
+        self.signer = bytes(data[signer_start:key_start]).decode("utf-8", "replace")
+        self.sig_key = ":".join("%02X" % b for b in data[key_start:sig_start])
+        self.sig_id = "PKCS#7" if id_type == PKEY_ID_PKCS7 else ""
@@ -0,0 +1,314 @@
+import bz2
+import gzip
+import lzma
+import struct
+from stat import S_IFLNK, S_IFREG
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+
+# rpm queryformat of the signature of a package, whichever of the header
+# or header+payload, DSA/EdDSA or RSA signature it has, "(none)" if none.
+RPM_SIGNATURE_QUERYFORMAT = (
+    "%|DSAHEADER?{%{DSAHEADER:pgpsig}}:{%|RSAHEADER?{%{RSAHEADER:pgpsig}}:"
+    "{%|SIGGPG?{%{SIGGPG:pgpsig}}:{%|SIGPGP?{%{SIGPGP:pgpsig}}:{(none)}|}|}|}|"
+)
+
+RPM_LEAD_MAGIC = b"\xed\xab\xee\xdb"
+RPM_LEAD_SIZE = 96
+HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+
+RPMTAG_FILESIZES = 1028
+RPMTAG_FILEMODES = 1030
+RPMTAG_FILEDEVICES = 1095
+RPMTAG_FILEINODES = 1096
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPMTAG_LONGFILESIZES = 5008
+
+RPM_CHAR_TYPE = 1
+RPM_INT8_TYPE = 2
+RPM_INT16_TYPE = 3
+RPM_INT32_TYPE = 4
+RPM_INT64_TYPE = 5
+RPM_STRING_TYPE = 6
+RPM_BIN_TYPE = 7
+RPM_STRING_ARRAY_TYPE = 8
+RPM_I18NSTRING_TYPE = 9
+
+_INT_FORMATS = {
+    RPM_CHAR_TYPE: "B",
+    RPM_INT8_TYPE: "B",
+    RPM_INT16_TYPE: "H",
+    RPM_INT32_TYPE: "I",
+    RPM_INT64_TYPE: "Q",
+}
+
+CPIO_NEWC_MAGIC = b"070701"
+CPIO_CRC_MAGIC = b"070702"
+CPIO_STRIPPED_MAGIC = b"07070X"
+CPIO_NEWC_HEADER_SIZE = 110
+CPIO_STRIPPED_HEADER_SIZE = 14
+CPIO_TRAILER = "TRAILER!!!"
+
+_READ_CHUNK = 1024 * 1024
+
+
+class RPMFormatError(Exception):
+    pass
+
+
+class RPMHeader:
+    """Tag store of a signature or main header, values are decoded on demand."""
+
+    def __init__(self, index, store, raw):
+        self._index = index
+        self._store = store
+        self.raw = raw
+
+    def __contains__(self, tag):
+        return tag in self._index
+
+    def get(self, tag, default=None):
+        entry = self._index.get(tag, None)
+        if entry is None:
+            return default
+
+        type, offset, count = entry
+        if type in _INT_FORMATS:
+            fmt = ">%d%s" % (count, _INT_FORMATS[type])
+            return list(struct.unpack_from(fmt, self._store, offset))
+        if type == RPM_BIN_TYPE:
+            return self._store[offset : offset + count]
+
+        strings = []
+        for __ in range(count):
+            end = self._store.index(b"\0", offset)
+            strings.append(self._store[offset:end].decode("utf-8", "replace"))
+            offset = end + 1
+        if type == RPM_STRING_TYPE:
+            return strings[0]
+
+        return strings
+
+
+def _read_exact(fp, size, path):
+    # decompression streams may return short reads before the end.
+    data = fp.read(size)
+    while len(data) < size:
+        chunk = fp.read(size - len(data))
+        if not chunk:
+            raise RPMFormatError("%s: unexpected end of file" % path)
+        data += chunk
+
+    return data
+
+
+def _read_header(fp, path, align=False):
+    intro = _read_exact(fp, 16, path)
+    if intro[:4] != HEADER_MAGIC:
+        raise RPMFormatError("%s: bad header magic" % path)
+
+    nindex, hsize = struct.unpack(">II", intro[8:])
+    index_data = _read_exact(fp, nindex * 16, path)
+    store = _read_exact(fp, hsize, path)
+    # the signature header is padded to a multiple of 8 bytes.
+    if align and hsize % 8:
+        _read_exact(fp, 8 - hsize % 8, path)
+
+    index = {}
+    for tag, type, offset, count in struct.iter_unpack(">IIiI", index_data):
+        index[tag] = (type, offset, count)
+
+    return RPMHeader(index, store, intro + index_data + store)
+
+
+def _skip(fp, size, path):
+    while size > 0:
+        chunk = fp.read(min(size, _READ_CHUNK))
+        if not chunk:
+            raise RPMFormatError("%s: unexpected end of payload" % path)
+        size -= len(chunk)
+
+
+def _file_type(mode):
+    return mode & 0o170000
+
+
+def _pad4(size):
+    return (4 - size % 4) % 4
+
+
+def _normalize_name(name):
+    # cpio names are "./lib/modules/...", file names in header are "/lib/modules/..."
+    if name.startswith("."):
+        name = name[1:]
+
+    return name
+
+
+class RPMFile:
+    """Stream an RPM file: lead, signature header, header and cpio payload.
+
+    Nothing is extracted to disk, payload entries are read in order and
+    only the ones accepted by the caller are kept in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, "rb")
+        try:
+            lead = _read_exact(self._fp, RPM_LEAD_SIZE, path)
+            if lead[:4] != RPM_LEAD_MAGIC:
+                raise RPMFormatError("%s: not an rpm package" % path)
+            self.signature = _read_header(self._fp, path, align=True)
+            self.header = _read_header(self._fp, path)
+        except Exception:
+            self._fp.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._fp.close()
+
+    def _payload_stream(self):
+        compressor = self.header.get(RPMTAG_PAYLOADCOMPRESSOR, "gzip")
+        if compressor == "gzip":
+            return gzip.GzipFile(fileobj=self._fp, mode="rb")
+        if compressor in ("xz", "lzma"):
+            return lzma.LZMAFile(self._fp)
+        if compressor == "bzip2":
+            return bz2.BZ2File(self._fp)
+        if compressor == "zstd":
+            if zstd is None:
+                raise RPMFormatError(
+                    "%s: zstd payload needs the 'zstandard' module" % self.path
+                )
+            if hasattr(zstd, "ZstdFile"):
+                return zstd.ZstdFile(self._fp)
+            return zstd.ZstdDecompressor().stream_reader(self._fp)
+        if compressor in ("identity", "none"):
+            return self._fp
+
+        raise RPMFormatError(
+            "%s: unsupported payload compressor %s" % (self.path, compressor)
+        )
+
+    def _header_files(self):
+        """(name, size of the data in the payload, regular, hard link set,
+        whether the data comes with it) of the files of the header, by
+        index, for the stripped cpio payload where the entries only have
+        that index.
+
+        Like in a newc payload, only the regular files and the symbolic
+        links (their target) have data, and the data of a set of hard
+        links comes with the last file of the set.
+        """
+        basenames = self.header.get(RPMTAG_BASENAMES, [])
+        dirnames = self.header.get(RPMTAG_DIRNAMES, [])
+        dirindexes = self.header.get(RPMTAG_DIRINDEXES, [])
+        sizes = self.header.get(RPMTAG_LONGFILESIZES, None)
+        if sizes is None:
+            sizes = self.header.get(RPMTAG_FILESIZES, [])
+        names = [dirnames[d] + b for d, b in zip(dirindexes, basenames)]
+        count = len(names)
+        modes = self.header.get(RPMTAG_FILEMODES, [S_IFREG] * count)
+        devices = self.header.get(RPMTAG_FILEDEVICES, [0] * count)
+        inodes = self.header.get(RPMTAG_FILEINODES, list(range(count)))
+
+        links = [(dev, ino) for dev, ino in zip(devices, inodes)]
+        last = {}
+        for fx in range(count):
+            if _file_type(modes[fx]) == S_IFREG:
+                last[links[fx]] = fx
+
+        files = []
+        for fx in range(count):
+            file_type = _file_type(modes[fx])
+            regular = file_type == S_IFREG
+            with_data = not regular or last[links[fx]] == fx
+            if (regular and with_data) or file_type == S_IFLNK:
+                size = sizes[fx]
+            else:
+                size = 0
+            files.append((names[fx], size, regular, links[fx], with_data))
+
+        return files
+
+    def iter_payload(self, accept):
+        """Yield (name, data) for every regular payload file accepted by
+        accept(name). The names are absolute paths as installed."""
+        payload = self._payload_stream()
+        header_files = None
+        # newc stores the data of hard links with the last link only.
+        pending_links = {}
+
+        while True:
+            magic = _read_exact(payload, 6, self.path)
+            if magic == CPIO_STRIPPED_MAGIC:
+                if header_files is None:
+                    header_files = self._header_files()
+                fx = int(_read_exact(payload, 8, self.path), 16)
+                _read_exact(payload, _pad4(CPIO_STRIPPED_HEADER_SIZE), self.path)
+                if fx >= len(header_files):
+                    raise RPMFormatError(
+                        "%s: no file %d in the header" % (self.path, fx)
+                    )
+                name, size, regular, link, with_data = header_files[fx]
+                wanted = regular and accept(name)
+                if wanted and not with_data:
+                    pending_links.setdefault(link, []).append(name)
+                elif wanted or (regular and link in pending_links):
+                    data = _read_exact(payload, size, self.path)
+                    for other in pending_links.pop(link, []):
+                        yield other, data
+                    if wanted:
+                        yield name, data
+                else:
+                    _skip(payload, size, self.path)
+                _read_exact(payload, _pad4(size), self.path)
+                continue
+
+            if magic not in (CPIO_NEWC_MAGIC, CPIO_CRC_MAGIC):
+                raise RPMFormatError("%s: bad cpio magic %r" % (self.path, magic))
+
+            fields = _read_exact(payload, CPIO_NEWC_HEADER_SIZE - 6, self.path)
+            ino, mode, __, __, nlink, __, size = (
+                int(fields[i : i + 8], 16) for i in range(0, 56, 8)
+            )
+            namesize = int(fields[88:96], 16)
+            name = _read_exact(payload, namesize, self.path)
+            name = name[:-1].decode("utf-8", "replace")
+            _read_exact(payload, _pad4(CPIO_NEWC_HEADER_SIZE + namesize), self.path)
+
+            if name == CPIO_TRAILER:
+                break
+
+            name = _normalize_name(name)
+            is_regular = _file_type(mode) == S_IFREG
+            wanted = is_regular and accept(name)
+            if wanted and size == 0 and nlink > 1:
+                pending_links.setdefault(ino, []).append(name)
+            elif wanted or (is_regular and ino in pending_links and size > 0):
+                data = _read_exact(payload, size, self.path)
+                for link in pending_links.pop(ino, []):
+                    yield link, data
+                if wanted:
+                    yield name, data
+            else:
+                _skip(payload, size, self.path)
+            _read_exact(payload, _pad4(size), self.path)
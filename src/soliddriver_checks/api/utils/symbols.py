@@ -0,0 +1,54 @@
+from itertools import chain
+import numpy as np
+import pandas as pd
+
+
+def _flatten(groups):
+    """Names, uint32 CRCs and group index of a list of {name: crc}."""
+    sizes = [len(g) for g in groups]
+    total = sum(sizes)
+    names = list(chain.from_iterable(groups))
+    crcs = np.fromiter(chain.from_iterable(g.values() for g in groups), np.int64, total)
+    group = np.repeat(np.arange(len(groups), dtype=np.uint64), sizes)
+
+    return names, (crcs & 0xFFFFFFFF).astype(np.uint32), group
+
+
+def check_symbols(modules, requires, owners):
+    """Check the symbol CRCs of many kernel modules in one batch.
+
+    modules and requires are lists of {name: crc}, the symbols used by
+    every module and the ksym() requires of every KMP, owners[i] is the
+    index in requires of the KMP of modules[i]. The symbol names are
+    interned into integer IDs, then every (KMP, ID) becomes one uint64
+    key, so the whole batch is looked up with one sorted search.
+
+    Returns two arrays with, for every module, the number of symbols
+    which are not required by its KMP and the number of symbols required
+    with another CRC.
+    """
+    mod_names, mod_crcs, mod_group = _flatten(modules)
+    req_names, req_crcs, req_group = _flatten(requires)
+    mod_group = np.asarray(owners, dtype=np.uint64)[mod_group.astype(np.intp)]
+
+    ids, __ = pd.factorize(np.array(mod_names + req_names, dtype=object))
+    ids = ids.astype(np.uint64)
+    mod_keys = (mod_group << np.uint64(32)) | ids[: len(mod_names)]
+    req_keys = (req_group << np.uint64(32)) | ids[len(mod_names) :]
+
+    order = np.argsort(req_keys)
+    req_keys, req_crcs = req_keys[order], req_crcs[order]
+    pos = np.searchsorted(req_keys, mod_keys)
+    pos = np.minimum(pos, max(len(req_keys) - 1, 0))
+    if len(req_keys):
+        found = req_keys[pos] == mod_keys
+        mismatched = found & (req_crcs[pos] != mod_crcs)
+    else:
+        found = np.zeros(len(mod_keys), bool)
+        mismatched = found
+
+    module = np.repeat(np.arange(len(modules)), [len(m) for m in modules])
+    return (
+        np.bincount(module[~found], minlength=len(modules)),
+        np.bincount(module[mismatched], minlength=len(modules)),
+    )
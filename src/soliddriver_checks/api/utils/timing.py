@@ -0,0 +1,38 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class StageTimer:
+    """Accumulate wall time and call counts per named stage."""
+
+    def __init__(self):
+        self._elapsed = defaultdict(float)
+        self._calls = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self._elapsed[name] += perf_counter() - start
+            self._calls[name] += 1
+
+    def merge(self, other):
+        for name, elapsed in other._elapsed.items():
+            self._elapsed[name] += elapsed
+        for name, calls in other._calls.items():
+            self._calls[name] += calls
+
+    def report(self):
+        return {
+            name: {"calls": self._calls[name], "seconds": self._elapsed[name]}
+            for name in self._elapsed
+        }
+
+    def __str__(self):
+        return ", ".join(
+            f"{name}: {self._elapsed[name]:.2f}s/{self._calls[name]}"
+            for name in self._elapsed
+        )
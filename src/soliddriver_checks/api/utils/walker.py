@@ -0,0 +1,59 @@
+import os
+import re
+
+KMP_FILE_RE = re.compile(r"-kmp-.*\.rpm$")
+
+
+class KMPFileWalker:
+    """Find KMP files under a directory with os.scandir.
+
+    Matches are yielded as soon as they are found. Directories in exclude
+    are not entered. With an index (see cache.KMPFileIndex), only the KMPs
+    which are new or changed since they were last checked are yielded.
+    """
+
+    def __init__(self, follow_symlinks=False, exclude=(), index=None):
+        self._follow_symlinks = follow_symlinks
+        self._exclude = set(os.path.abspath(e) for e in exclude)
+        self._index = index
+
+    def walk(self, root):
+        for path, st in self._scan(root):
+            if self._index is not None:
+                sig = [st.st_size, st.st_mtime_ns, st.st_ino]
+                if not self._index.changed(path, sig):
+                    continue
+            yield path
+
+    def checked(self, path):
+        """Record that the result of a KMP yielded by walk was produced."""
+        if self._index is not None:
+            self._index.checked(path)
+
+    def _scan(self, root):
+        visited = set()
+        stack = [root]
+        while stack:
+            top = stack.pop()
+            if os.path.abspath(top) in self._exclude:
+                continue
+            try:
+                st = os.stat(top)
+                # symbolic links may create loops
+                if (st.st_dev, st.st_ino) in visited:
+                    continue
+                visited.add((st.st_dev, st.st_ino))
+                entries = sorted(os.scandir(top), key=lambda e: e.name)
+            except OSError:
+                continue
+
+            dirs = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=self._follow_symlinks):
+                        dirs.append(entry.path)
+                    elif KMP_FILE_RE.search(entry.path) and entry.is_file():
+                        yield entry.path, entry.stat()
+                except OSError:
+                    continue
+            stack.extend(reversed(dirs))
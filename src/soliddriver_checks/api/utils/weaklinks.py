@@ -0,0 +1,74 @@
+import os
+import stat
+from collections import namedtuple
+from .kmfile import is_kernel_module
+
+# status of a module under weak-updates, the values of the former
+# check-links.sh script.
+LINK_OK = 1
+LINK_DANGLING = 2
+NOT_A_LINK = 3
+
+# kernel is the release of the weak-updates tree, target the path the
+# link points to and target_kernel the release of the tree of the target,
+# None for the files out of the modules root.
+WeakUpdate = namedtuple(
+    "WeakUpdate", ["path", "kernel", "status", "target", "target_kernel"]
+)
+
+
+def _target_kernel(target, modules_root):
+    rel = os.path.relpath(target, modules_root)
+    if rel.startswith(os.pardir):
+        return None
+
+    return rel.split(os.sep, 1)[0]
+
+
+def _scan_tree(path, kernel, modules_root):
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return
+
+    for entry in entries:
+        # the type of the entries comes with scandir, no stat for them
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scan_tree(entry.path, kernel, modules_root)
+            continue
+        if not is_kernel_module(entry.name):
+            continue
+        if not entry.is_symlink():
+            yield WeakUpdate(entry.path, kernel, NOT_A_LINK, None, None)
+            continue
+
+        try:
+            target = os.path.normpath(os.path.join(path, os.readlink(entry.path)))
+        except OSError:  # removed meanwhile
+            continue
+        try:
+            regular = stat.S_ISREG(os.stat(entry.path).st_mode)
+        except OSError:
+            regular = False
+        status = LINK_OK if regular else LINK_DANGLING
+        yield WeakUpdate(
+            entry.path, kernel, status, target, _target_kernel(target, modules_root)
+        )
+
+
+def scan_weak_updates(modules_root="/lib/modules"):
+    """Yield a WeakUpdate for every module under the weak-updates
+    directory of every kernel.
+
+    A module there should be a link to an existing module of another
+    kernel, it's installed by weak-modules2 for the KABI compatible
+    kernels. Only the links are followed, with one stat each.
+    """
+    try:
+        kernels = sorted(e.name for e in os.scandir(modules_root) if e.is_dir())
+    except OSError:
+        return
+
+    for kernel in kernels:
+        weak = os.path.join(modules_root, kernel, "weak-updates")
+        yield from _scan_tree(weak, kernel, modules_root)
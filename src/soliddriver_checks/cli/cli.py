@@ -2,6 +2,11 @@ import click
 import json
 from ..api import analysis
 from ..api.km import read_remote_json
+from ..api.utils.timing import StageTimer
+from ..api.cache import KMPResultCache, KMPFileIndex, KMInfoCache
+from ..api.kabi import KABILibrary, KABIFormatError, index_symvers
+from ..api.utils.modalias import ModulesAlias
+from ..api.utils.walker import KMPFileWalker
 from .terminal_logs import KMPTerminalOutput, single_kmp_output
 from .kmp_report import KMPReporter
 from .km_report import KMReporter
@@ -19,6 +24,7 @@ FORMAT_TYPES = {
     "html": ".html",
     "xlsx": ".xlsx",
     "json": ".json",
+    "ndjson": ".ndjson",
 }
 
 
@@ -34,6 +40,13 @@ class Check_Target:
         target = Path(self._target)
         return target.name == "system" and not (target.is_file() or target.is_dir())
 
+    @property
+    def index_symvers(self):
+        target = Path(self._target)
+        return target.name == "index-symvers" and not (
+            target.is_file() or target.is_dir()
+        )
+
     @property
     def rpm(self):
         # need better check than this
@@ -87,6 +100,8 @@ def kmp_export(exporter, check_result, out_format, dst):
         exporter.to_xlsx(check_result, dst)
     elif out_format == "json":
         exporter.to_json(check_result, dst)
+    elif out_format == "ndjson":
+        exporter.to_ndjson(check_result, dst)
 
 
 def km_export(exporter, label, check_result, filter, out_format, dst):
@@ -97,6 +112,8 @@ def km_export(exporter, label, check_result, filter, out_format, dst):
         exporter.to_xlsx(label, check_result, filter, dst)
     elif out_format == "json":
         exporter.to_json(label, check_result, filter, dst)
+    elif out_format == "ndjson":
+        exporter.to_ndjson(label, check_result, filter, dst)
 
 
 def dst_is_ok(dst, out_format):
@@ -151,8 +168,71 @@ def dst_is_ok(dst, out_format):
     "specified. In either case, the file extension will "
     "be automatically appended matching on the output format",
 )
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    type=click.IntRange(min=0),
+    help="Number of processes checking KMPs, or reading the modules of the "
+    "system, in parallel, 0 for one per CPU",
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Check all the KMPs or modules, don't use or update the result cache",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Check all the KMPs or modules again and update the result cache",
+)
+@click.option(
+    "--follow-symlinks",
+    is_flag=True,
+    help="Follow symbolic links to directories when looking for KMPs",
+)
+@click.option(
+    "--exclude",
+    "-x",
+    multiple=True,
+    type=click.Path(),
+    help="Directory not to look for KMPs in, can be repeated",
+)
+@click.option(
+    "--changed-only",
+    is_flag=True,
+    help="Only check the KMPs which are new or changed since they were last "
+    "reported",
+)
+@click.option(
+    "--kabi-dir",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+    help="Directory of symvers-<kernel release>.gz files to check "
+    "the KABI compatibility of the KMPs against",
+)
+@click.option(
+    "--modules-alias",
+    default=None,
+    help="modules.alias file, or release of an installed kernel, to find "
+    "the in-tree modules claiming the devices of the KMPs",
+)
 @click.option("--version", is_flag=True)
-def run(check_target, output, out_format, filter, version):
+def run(
+    check_target,
+    output,
+    out_format,
+    filter,
+    jobs,
+    no_cache,
+    refresh,
+    follow_symlinks,
+    exclude,
+    changed_only,
+    kabi_dir,
+    modules_alias,
+    version,
+):
     """Run checks against CHECK_TARGET.
 
     \b
@@ -160,6 +240,7 @@ def run(check_target, output, out_format, filter, version):
       KMP file
       directory containing KMP files
       "system" to check locally installed kernel modules
+      "index-symvers" to index the symvers files of --kabi-dir
     """
 
     if version:
@@ -173,6 +254,18 @@ def run(check_target, output, out_format, filter, version):
 
     target = Check_Target(check_target)
 
+    if target.index_symvers:
+        if kabi_dir is None:
+            logger.error("index-symvers needs --kabi-dir")
+            exit(1)
+        try:
+            index = index_symvers(kabi_dir)
+        except (OSError, KABIFormatError) as e:
+            logger.error("Can't index the symvers files: %s" % e)
+            exit(1)
+        logger.info("The symvers index has been saved to %s" % index)
+        exit()
+
     dst = Path(output)
     if dst.is_dir() or output.endswith("/"):
         dst = dst / "check_result"
@@ -186,8 +279,28 @@ def run(check_target, output, out_format, filter, version):
         ext_to_format = {v: k for k, v in FORMAT_TYPES.items()}
         out_format = ext_to_format.get(dst.suffix, None)
 
+    kabi = None
+    if kabi_dir is not None:
+        try:
+            kabi = KABILibrary.load(kabi_dir)
+        except (OSError, KABIFormatError) as e:
+            logger.error("Can't load the KABI library: %s" % e)
+            exit(1)
+        logger.info("KABI library: %s" % " ".join(kabi.kernels))
+
+    aliases = None
+    if modules_alias is not None:
+        try:
+            if Path(modules_alias).is_file():
+                aliases = ModulesAlias.load(modules_alias)
+            else:
+                aliases = ModulesAlias.for_kernel(modules_alias)
+        except OSError as e:
+            logger.error("Can't load the modules.alias: %s" % e)
+            exit(1)
+
     if target.rpm:
-        df = analysis.kmp_analysis(target.rpm)
+        df = analysis.kmp_analysis(target.rpm, kabi, aliases)
         single_kmp_output(df)
 
     elif target.dir:
@@ -197,11 +310,58 @@ def run(check_target, output, out_format, filter, version):
             BarColumn(),
             TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
         )
+        reporter = KMPReporter()
         with progress:
             log = KMPTerminalOutput(progress)
-            df = analysis.kmps_to_dataframe(target.dir, log, filter)
-        reporter = KMPReporter()
-        kmp_export(reporter, df, out_format, dst)
+            timer = StageTimer()
+            cache = (
+                None
+                if no_cache
+                else KMPResultCache(refresh=refresh, kabi=kabi, modules_alias=aliases)
+            )
+            index = KMPFileIndex(target.dir) if changed_only else None
+            walker = KMPFileWalker(follow_symlinks, exclude, index)
+            try:
+                if out_format == "ndjson":
+                    # one line per KMP, written while the check is running.
+                    results = analysis.iter_kmp_results(
+                        target.dir,
+                        log,
+                        filter,
+                        timer,
+                        jobs,
+                        cache,
+                        walker,
+                        kabi,
+                        aliases,
+                    )
+                    dst = with_format_suffix(dst, out_format)
+                    reporter.write_ndjson(results, dst)
+                else:
+                    df = analysis.kmps_to_dataframe(
+                        target.dir,
+                        log,
+                        filter,
+                        timer,
+                        jobs,
+                        cache,
+                        walker,
+                        kabi,
+                        aliases,
+                    )
+            finally:
+                if cache is not None:
+                    cache.close()
+        logger.info("Time spent per stage: %s" % timer)
+        if cache is not None:
+            logger.info(
+                "Result cache: %d hit(s), %d miss(es)" % (cache.hits, cache.misses)
+            )
+        if out_format != "ndjson":
+            kmp_export(reporter, df, out_format, dst)
+        if index is not None:
+            # only once the results are in the report
+            index.save()
         logger.info(
             "[green]Check is completed![/]"
             "The result has been saved to "
@@ -220,7 +380,17 @@ def run(check_target, output, out_format, filter, version):
         label = "%s (%s)" % (hostname, ip)
         logger.info("Retrieving kernel module data for %s" % label)
         reporter = KMReporter()
-        km_export(reporter, label, None, filter, out_format, dst)
+        cache = None if no_cache else KMInfoCache(refresh=refresh)
+        try:
+            df = analysis.kms_to_dataframe(filter, jobs, cache)
+        finally:
+            if cache is not None:
+                cache.close()
+        if cache is not None:
+            logger.info(
+                "Module cache: %d hit(s), %d miss(es)" % (cache.hits, cache.misses)
+            )
+        km_export(reporter, label, df, filter, out_format, dst)
     elif target.url:
         df = read_remote_json(target.url)
         reporter = KMReporter()
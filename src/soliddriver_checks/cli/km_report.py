@@ -1,10 +1,12 @@
 import os
 from openpyxl.utils.dataframe import dataframe_to_rows
 import json
+import pandas as pd
 from openpyxl import Workbook
 from jinja2 import Environment, FileSystemLoader
 from ..config import SDCConf, get_version, generate_timestamp
-from ..api.km import KMEvaluation
+from ..api.km import KMEvaluation, KM_CHECKS, kernel_compatibility
+from ..api import results
 from ..api.analysis import kms_to_dataframe, kms_to_json
 from .xlsx_utils import XlsxTemplate, KMXlsxStyler
 
@@ -13,60 +15,26 @@ class KMReporter:
     def __init__(self):
         self._style = SDCConf()
 
-    def _format_cell(slef, value):
-        if type(value) == dict:
-            return value.get("value", "")
-        else:
-            return value
+    def _cell_styles(self, levels):
+        cristyle = self._style.get_km_html_error()
+        impstyle = self._style.get_km_html_warning()
+        cri_bgcolor = cristyle["background-color"]
+        cri_color = cristyle["color"]
+        # cri_border = cristyle["border"]
 
-    def _row_style_in_html(self, row):
-        # TODO: row style should be added
-        def _get_cell_style(row_level, cell_level):
-            style = ""
-            cristyle = self._style.get_km_html_error()
-            impstyle = self._style.get_km_html_warning()
-            cri_bgcolor = cristyle["background-color"]
-            cri_color = cristyle["color"]
-            # cri_border = cristyle["border"]
-
-            imp_bgcolor = impstyle["background-color"]
-            # imp_border = impstyle["border"]
-
-            if int(KMEvaluation.WARNING) == cell_level:
-                style = f"background-color:{imp_bgcolor}"
-            elif int(KMEvaluation.ERROR) == cell_level:
-                style = f"background-color:{cri_bgcolor} color:{cri_color}"
-
-            return style
-
-        return [
-            "",  # level style, no need for this.
-            _get_cell_style(
-                KMEvaluation(row["level"]["value"]),
-                KMEvaluation(row["Module Name"]["level"]["value"]),
-            ),
-            _get_cell_style(
-                KMEvaluation(row["level"]["value"]),
-                KMEvaluation(row["File"]["level"]["value"]),
-            ),
-            _get_cell_style(
-                KMEvaluation(row["level"]["value"]),
-                KMEvaluation(row["License"]["level"]["value"]),
-            ),
-            _get_cell_style(
-                KMEvaluation(row["level"]["value"]),
-                KMEvaluation(row["Signature"]["level"]["value"]),
-            ),
-            _get_cell_style(
-                KMEvaluation(row["level"]["value"]),
-                KMEvaluation(row['"supported" Flag']["level"]["value"]),
-            ),
-            "",  # running style, no need for this.
-            _get_cell_style(
-                KMEvaluation(row["level"]["value"]),
-                KMEvaluation(row["KMP"]["level"]["value"]),
-            ),
-        ]
+        imp_bgcolor = impstyle["background-color"]
+        # imp_border = impstyle["border"]
+
+        styles = {
+            int(KMEvaluation.WARNING): f"background-color:{imp_bgcolor}",
+            int(KMEvaluation.ERROR): f"background-color:{cri_bgcolor} color:{cri_color}",
+        }
+        # running style, no need for this.
+        levels = levels.drop(columns=["running"])
+
+        return levels.apply(lambda c: c.map(styles).fillna("")).reindex(
+            columns=KM_CHECKS, fill_value=""
+        )
 
     def _format_columns(self, df):
         return df.rename(
@@ -78,9 +46,42 @@ class KMReporter:
                 "supported": '"supported" Flag',
                 "running": "Running",
                 "kmp": "KMP",
+                "kernel_compatibility": "Kernel Compatibility",
             }
         )
 
+    def _kernel_matrix(self, df):
+        """File x kernel table of the kernel_compatibility check, "yes",
+        "no", or "" for the kernels of another flavor."""
+        rows = {
+            f: kernel_compatibility(v)
+            for f, v in zip(df["filename"], df["kernel_compatibility"])
+            if v
+        }
+        matrix = pd.DataFrame.from_dict(rows, orient="index")
+        matrix = matrix.reindex(columns=sorted(matrix.columns))
+
+        return matrix.apply(lambda c: c.map({True: "yes", False: "no"}).fillna(""))
+
+    def _kernel_matrix_to_html(self, df):
+        matrix = self._kernel_matrix(df)
+        if matrix.empty:
+            return ""
+
+        impstyle = self._style.get_km_html_warning()
+        warning = f"background-color:{impstyle['background-color']}"
+        ts = (
+            matrix.rename_axis("File")
+            .reset_index()
+            .style.hide(axis="index")
+            .set_table_attributes('class="table_center"')
+        )
+        # Styler.map is Styler.applymap before pandas 2.1
+        style_map = ts.map if hasattr(ts, "map") else ts.applymap
+        ts = style_map(lambda v: warning if v == "no" else "")
+
+        return ts.to_html()
+
     def to_html(self, sys_info, df_format, filter, file):
         pkg_path = os.path.dirname(__file__)
         jinja_tmpl = f"{pkg_path}/../config/templates"
@@ -93,30 +94,29 @@ class KMReporter:
             df_format = kms_to_dataframe(filter)  # read from local system.
 
         kms_in_total = len(df_format.index)
-        failed_kms_in_total = len(
-            [
-                f
-                for f in df_format["level"].to_list()
-                if f["value"] != int(KMEvaluation.PASS)
-            ]
+        failed_kms_in_total = int(
+            (df_format["level"] != int(KMEvaluation.PASS)).sum()
+        )
+        # TODO: row style should be added
+        styles = self._format_columns(
+            self._cell_styles(results.level_frame(df_format, KM_CHECKS))
         )
 
-        df_format = self._format_columns(df_format)
+        kernels_table = self._kernel_matrix_to_html(df_format)
+
+        df_format = self._format_columns(results.value_frame(df_format, KM_CHECKS))
         ts = (
             df_format.style.hide(axis="index")
-            .hide([("level")], axis="columns")
             .set_table_attributes('class="table_center"')
-            .apply(self._row_style_in_html, axis=1)
-            .format(self._format_cell)
+            .apply(lambda __: styles, axis=None)
         )
 
         # df["running"].loc[df.running == True] = "&#9989;"
         # df["running"].loc[df.running == False] = "&#9940;"
         # df["running"].loc[df.running == ""] = "N/A"
 
-        # Will be easier to get the value if run this after reformat the values.
-        external_kms_in_total = len(
-            [sf for sf in df_format['"supported" Flag'].to_list() if sf == "external"]
+        external_kms_in_total = int(
+            (df_format['"supported" Flag'] == "external").sum()
         )
 
         kms_buffer = km_tmpl.render(
@@ -127,6 +127,7 @@ class KMReporter:
             external_kms_in_total=external_kms_in_total,
             failed_kms_in_total=failed_kms_in_total,
             kms_table=ts.to_html(),
+            kernels_table=kernels_table,
         )
 
         with open(file, "w") as f:
@@ -139,10 +140,7 @@ class KMReporter:
     def _create_xlsx_sheet(self, wb, sys_info, df):
         ws = wb.create_sheet(sys_info)
 
-        df_values = df.copy()
-        df_values = self._format_columns(df_values)
-        df_values = df_values.drop(["level"], axis=1)
-        df_values = df_values.applymap(lambda v: v.get("value", ""))
+        df_values = self._format_columns(results.value_frame(df, KM_CHECKS))
         # fill the values
         df_values = df_values.astype(str)
         for row in dataframe_to_rows(df_values, index=False, header=True):
@@ -163,27 +161,53 @@ class KMReporter:
             "E": "supported",
             "F": "running",
             "G": "kmp",
+            "H": "kernel_compatibility",
         }
 
         data_start_row = 2
         row_count = len(df.index) + data_start_row
+        levels = results.level_frame(df, KM_CHECKS)
         for i in range(data_start_row, row_count):
             # TODO: add row level style.
-            row_level = df.at[i - data_start_row, "level"]
             for cell in ws[i]:
-                v = df.at[i - data_start_row, pair[cell.column_letter]]
-                lev = v.get("level")
-                if lev["value"] == int(KMEvaluation.PASS):
+                lev = levels[pair[cell.column_letter]].iat[i - data_start_row]
+                if lev == int(KMEvaluation.PASS):
                     render.normal(cell)
-                elif lev["value"] == int(KMEvaluation.WARNING):
+                elif lev == int(KMEvaluation.WARNING):
                     render.warning(cell)
-                elif lev["value"] == int(KMEvaluation.ERROR):
+                elif lev == int(KMEvaluation.ERROR):
                     render.error(cell)
 
         render.set_column_width(
-            ws, {"A": 25, "B": 90, "C": 18, "D": 10, "E": 15, "F": 10, "G": 30}
+            ws,
+            {"A": 25, "B": 90, "C": 18, "D": 10, "E": 15, "F": 10, "G": 30, "H": 60},
         )
 
+    def _create_xlsx_kernel_sheet(self, wb, df):
+        matrix = self._kernel_matrix(df)
+        if matrix.empty:
+            return
+
+        ws = wb.create_sheet("Kernel Compatibility")
+        ws.append(["File"] + list(matrix.columns))
+        for filename, row in matrix.iterrows():
+            ws.append([filename] + list(row))
+
+        render = KMXlsxStyler()
+        for cell in ws[1]:
+            render.set_header(cell)
+        for row in ws.iter_rows(min_row=2):
+            for cell in row:
+                if cell.value == "no":
+                    render.warning(cell)
+                else:
+                    render.normal(cell)
+
+        widths = {"A": 90}
+        for cell in ws[1][1:]:
+            widths[cell.column_letter] = 30
+        render.set_column_width(ws, widths)
+
     def to_xlsx(self, sys_info, df_format, filter, file):
         wb = Workbook()
         self._create_xlsx_overview(wb.active)
@@ -192,11 +216,20 @@ class KMReporter:
             df_format = kms_to_dataframe(filter)
 
         self._create_xlsx_sheet(wb, sys_info, df_format)
+        self._create_xlsx_kernel_sheet(wb, df_format)
 
         wb.save(file)
 
+    def to_ndjson(self, sys_info, df_format, filter, file):
+        if df_format is None:
+            df_format = kms_to_dataframe(filter)
+
+        with open(file, "w") as fp:
+            for record in results.to_nested_records(df_format, KM_CHECKS):
+                fp.write(json.dumps(record) + "\n")
+
     def to_json(self, sys_info, df_format, filter, file):
-        buffer = kms_to_json(df_format)
+        buffer = kms_to_json(df_format, filter)
 
         # TODO: add sys_info to json output.
         with open(file, "w") as fp:
@@ -1,4 +1,3 @@
-import pandas as pd
 import os
 from dominate.tags import tr, td, th, table
 from dominate.util import raw
@@ -6,7 +5,10 @@ from openpyxl.utils.dataframe import dataframe_to_rows
 from openpyxl import Workbook
 from jinja2 import Environment, FileSystemLoader
 from ..config import SDCConf, get_version, generate_timestamp
-from ..api.kmp import KMPEvaluation
+from ..api.kmp import KMPEvaluation, KMP_CHECKS, analysis_kmp_to_record
+from ..api import results
+import json
+from ..api.utils.frame import ColumnarFrameBuilder
 from .xlsx_utils import XlsxTemplate, KMPXlsxStyler
 
 
@@ -15,54 +17,35 @@ class KMPReporter:
         self._style = SDCConf()
 
     def _summary(self, df):
-        summary = df.copy()
-        # we need to do this for unique() since unhashable type: 'dict'.
-        for i, row in summary.iterrows():
-            row["vendor"] = row["vendor"]["value"]
-
-        def failed_len(col):
-            counter = 0
-            for v in col:
-                eval = v.get("level")
-                if eval["value"] != int(KMPEvaluation.PASS):
-                    counter += 1
-            return counter
-
         def format_cell(number, total):
             return f"{number} ({number/total * 100:.2f}%)"
 
-        vendors = summary["vendor"].unique()
-        sum_table = pd.DataFrame()
-        for v in vendors:
-            vendor_df = summary.loc[summary["vendor"] == v]
-            total = len(vendor_df.index)
-            sig_failed = failed_len(vendor_df["signature"])
-            license_failed = failed_len(vendor_df["license"])
-            supported_failed = failed_len(vendor_df["supported_flag"])
-            wm2_invoked_failed = failed_len(vendor_df["wm2_invoked"])
-            km_sigs_failed = failed_len(vendor_df["km_signatures"])
-            km_license_failed = failed_len(vendor_df["km_licenses"])
-            symbols_failed = failed_len(vendor_df["symbols"])
-            alias_failed = failed_len(vendor_df["modalias"])
-
-            new_row = pd.Series(
-                {
-                    "Vendor": v,
-                    "Total KMPs": total,
-                    "License": format_cell(license_failed, total),
-                    "KMP Signature": format_cell(sig_failed, total),
-                    "Weak Module Invoked": format_cell(wm2_invoked_failed, total),
-                    "Supported Flag": format_cell(supported_failed, total),
-                    "KM Signatures": format_cell(km_sigs_failed, total),
-                    "KM Licenses": format_cell(km_license_failed, total),
-                    "Symbols": format_cell(symbols_failed, total),
-                    "Modalias": format_cell(alias_failed, total),
-                }
-            )
-
-            sum_table = pd.concat([sum_table, new_row.to_frame().T], ignore_index=True)
-
-        return sum_table
+        checks = {
+            "License": "license",
+            "KMP Signature": "signature",
+            "Weak Module Invoked": "wm2_invoked",
+            "Supported Flag": "supported_flag",
+            "KM Signatures": "km_signatures",
+            "KM Licenses": "km_licenses",
+            "Symbols": "symbols",
+            "Modalias": "modalias",
+            "KABI Compatibility": "kabi_compatibility",
+            "Alias Conflicts": "alias_conflicts",
+        }
+        failed = results.level_frame(df, list(checks.values())) != int(
+            KMPEvaluation.PASS
+        )
+        by_vendor = failed.groupby(df["vendor"], observed=True, sort=False)
+        failed_counts = by_vendor.sum()
+
+        sum_table = ColumnarFrameBuilder(["Vendor", "Total KMPs"] + list(checks))
+        for v, total in by_vendor.size().items():
+            row = {"Vendor": v, "Total KMPs": total}
+            for title, check in checks.items():
+                row[title] = format_cell(failed_counts.at[v, check], total)
+            sum_table.append(row)
+
+        return sum_table.build()
 
     def _summary_to_html(self, df):
         tb = table()
@@ -92,6 +75,8 @@ class KMPReporter:
                 km_license = row["KM Licenses"]
                 symbols = row["Symbols"]
                 alias = row["Modalias"]
+                kabi = row["KABI Compatibility"]
+                conflicts = row["Alias Conflicts"]
 
                 row_passed = False
                 if (
@@ -104,6 +89,8 @@ class KMPReporter:
                     and _pass(km_license)
                     and _pass(symbols)
                     and _pass(alias)
+                    and _pass(kabi)
+                    and _pass(conflicts)
                 ):
                     row_passed = True
                 with tr() as r:
@@ -156,20 +143,30 @@ class KMPReporter:
                             t.set_attribute("class", "summary_number")
                         else:
                             t.set_attribute("class", "critical_failed summary_number")
+                    with td(kabi) as t:
+                        if _pass(kabi):
+                            t.set_attribute("class", "summary_number")
+                        else:
+                            t.set_attribute("class", "important_failed summary_number")
+                    with td(conflicts) as t:
+                        if _pass(conflicts):
+                            t.set_attribute("class", "summary_number")
+                        else:
+                            t.set_attribute("class", "important_failed summary_number")
 
         return tb
 
     def _detail_to_html(self, df):
-        def _create_cell(ana_val):
-            level, value = ana_val.get("level"), ana_val.get("value")
+        def _create_cell(row, check):
+            level, value = row[results.level_column(check)], row[check]
             if value is None:
                 value = ""
 
-            if level["value"] == int(KMPEvaluation.PASS):
+            if level == int(KMPEvaluation.PASS):
                 return td(value)
-            elif level["value"] == int(KMPEvaluation.WARNING):
+            elif level == int(KMPEvaluation.WARNING):
                 return td(value).set_attribute("class", "important_failed")
-            elif level["value"] == int(KMPEvaluation.ERROR):
+            elif level == int(KMPEvaluation.ERROR):
                 return td(value).set_attribute("class", "critical_failed")
 
         tb = table()
@@ -180,6 +177,9 @@ class KMPReporter:
                 th("Kernel Module Checks", colspan=5).set_attribute(
                     "class", f"detail_kernel_module"
                 )
+                th("Target Kernel Checks", colspan=2).set_attribute(
+                    "class", f"detail_rpm"
+                )
             with tr():
                 th("Name").set_attribute("class", f"detail_0")
                 th("Path").set_attribute("class", f"detail_1")
@@ -224,25 +224,37 @@ class KMPReporter:
                         'Modalias<span class="tooltiptext">Modalias check is to check whether the modalias in kernel modules matches the modalias in its package.</span>'
                     )
                 ).set_attribute("class", f"detail_8 tooltip")
+                th(
+                    raw(
+                        'KABI Compatibility<span class="tooltiptext">The kernels of the KABI library providing all the ksym() requires of the package.</span>'
+                    )
+                ).set_attribute("class", f"detail_8 tooltip")
+                th(
+                    raw(
+                        'Alias Conflicts<span class="tooltiptext">The in-tree kernel modules also claiming the devices of the kernel modules in the package.</span>'
+                    )
+                ).set_attribute("class", f"detail_8 tooltip")
 
-            for __, row in df.iterrows():
+            for row in df.to_dict(orient="records"):
                 with tr() as r:
-                    if row["level"]["value"] == int(KMPEvaluation.WARNING):
+                    if row["level"] == int(KMPEvaluation.WARNING):
                         r.set_attribute("class", "important_failed_row")
-                    elif row["level"]["value"] == int(KMPEvaluation.ERROR):
+                    elif row["level"] == int(KMPEvaluation.ERROR):
                         r.set_attribute("class", "critical_failed_row")
 
-                    _create_cell(row["name"])
-                    _create_cell(row["path"])
-                    _create_cell(row["vendor"])
-                    _create_cell(row["signature"])
-                    _create_cell(row["license"])
-                    _create_cell(row["wm2_invoked"])
-                    _create_cell(row["km_licenses"])
-                    _create_cell(row["km_signatures"])
-                    _create_cell(row["supported_flag"])
-                    _create_cell(row["symbols"])
-                    _create_cell(row["modalias"])
+                    _create_cell(row, "name")
+                    _create_cell(row, "path")
+                    _create_cell(row, "vendor")
+                    _create_cell(row, "signature")
+                    _create_cell(row, "license")
+                    _create_cell(row, "wm2_invoked")
+                    _create_cell(row, "km_licenses")
+                    _create_cell(row, "km_signatures")
+                    _create_cell(row, "supported_flag")
+                    _create_cell(row, "symbols")
+                    _create_cell(row, "modalias")
+                    _create_cell(row, "kabi_compatibility")
+                    _create_cell(row, "alias_conflicts")
 
         return tb
 
@@ -278,12 +290,23 @@ class KMPReporter:
 
     def _detail_to_xlsx(self, wb, df):
         ws = wb.create_sheet("KMP Detail")
-        df_values = df.copy()
-        # format value
-        df_values = df_values.drop(["level"], axis=1)
-        df_values = df_values.applymap(lambda v: v.get("value", ""))
-        # fill the values
-        df_values = df_values.astype(str)
+        pair = {
+            "A": "name",
+            "B": "path",
+            "C": "vendor",
+            "D": "signature",
+            "E": "license",
+            "F": "wm2_invoked",
+            "G": "km_licenses",
+            "H": "km_signatures",
+            "I": "supported_flag",
+            "J": "symbols",
+            "K": "modalias",
+            "L": "kabi_compatibility",
+            "M": "alias_conflicts",
+        }
+        # fill the values, in the column order of the header
+        df_values = results.value_frame(df, list(pair.values())).astype(str)
         for row in dataframe_to_rows(df_values, index=False, header=False):
             ws.append(row)
 
@@ -311,38 +334,27 @@ class KMPReporter:
                 "I2": "Supported Flag",
                 "J2": "Symbols",
                 "K2": "Modalias",
+                "L1": "Target Kernel Checks",
+                "L2": "KABI Compatibility",
+                "M2": "Alias Conflicts",
             }
         )
         ws.merge_cells("A1:F1")
         ws.merge_cells("G1:K1")
-
-        pair = {
-            "A": "name",
-            "B": "path",
-            "C": "vendor",
-            "D": "signature",
-            "E": "license",
-            "F": "wm2_invoked",
-            "G": "km_licenses",
-            "H": "km_signatures",
-            "I": "supported_flag",
-            "J": "symbols",
-            "K": "modalias",
-        }
+        ws.merge_cells("L1:M1")
 
         data_start_row = 3
         row_count = len(df.index) + data_start_row
+        levels = results.level_frame(df, KMP_CHECKS)
         for i in range(data_start_row, row_count):
             # TODO: add row level style.
-            row_level = df.at[i - data_start_row, "level"]
             for cell in ws[i]:
-                v = df.at[i - data_start_row, pair[cell.column_letter]]
-                lev = v.get("level")
-                if lev["value"] == int(KMPEvaluation.PASS):
+                lev = levels[pair[cell.column_letter]].iat[i - data_start_row]
+                if lev == int(KMPEvaluation.PASS):
                     render.normal(cell)
-                elif lev["value"] == int(KMPEvaluation.WARNING):
+                elif lev == int(KMPEvaluation.WARNING):
                     render.warning(cell)
-                elif lev["value"] == int(KMPEvaluation.ERROR):
+                elif lev == int(KMPEvaluation.ERROR):
                     render.error(cell)
 
         render.set_column_width(
@@ -359,6 +371,8 @@ class KMPReporter:
                 "I": 30,
                 "J": 60,
                 "K": 40,
+                "L": 40,
+                "M": 60,
             },
         )
 
@@ -373,4 +387,17 @@ class KMPReporter:
         wb.save(file)
 
     def to_json(self, df, file):
-        df.to_json(file, orient="records")
+        with open(file, "w") as fp:
+            fp.write(results.to_json(df, KMP_CHECKS))
+
+    def to_ndjson(self, df, file):
+        with open(file, "w") as fp:
+            for record in results.to_nested_records(df, KMP_CHECKS):
+                fp.write(json.dumps(record) + "\n")
+
+    def write_ndjson(self, records, file):
+        """Write every KMPAnalysis result as one line, as soon as it comes."""
+        with open(file, "w") as fp:
+            for item in records:
+                fp.write(json.dumps(analysis_kmp_to_record(item)) + "\n")
+                fp.flush()
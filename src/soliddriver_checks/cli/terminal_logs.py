@@ -6,17 +6,27 @@ class KMPTerminalOutput:
         self._progress = progress
 
     def prepartion(self, kmps):
+        # kmps is None when they are checked while they are found
+        if kmps is None:
+            self._task = self._progress.add_task(
+                "[italic][bold][green] Checking RPMs ", total=None
+            )
+            return
+
         self._task = self._progress.add_task(
             "[italic][bold][green] Checking RPMs " + "; Total RPMs: " + str(len(kmps)),
             total=len(kmps),
         )
 
     def process(self, data):
-        self._progress.console.print(data)
+        if data is not None:  # None: skipped by the filter
+            self._progress.console.print(data)
         self._progress.advance(self._task)
 
     def complete(self):
-        pass
+        task = next(t for t in self._progress.tasks if t.id == self._task)
+        if task.total is None:
+            self._progress.update(self._task, total=task.completed)
 
 
 def single_kmp_output(df):
@@ -124,9 +124,9 @@ class KMPXlsxStyler(XlsxStyler):
             ),
         )
         row_pass.formula = [
-            'AND($A2 <> "", VALUE(LEFT($C2, FIND(" ",$C2)-1))=0, VALUE(LEFT($D2, FIND(" ", $D2) - 1)) = 0, VALUE(LEFT($E2, FIND(" ", $E2) - 1)) = 0, VALUE(LEFT($F2, FIND(" ", $F2)-1))=0, VALUE(LEFT($G2, FIND(" ", $G2) - 1))=0, VALUE(LEFT($H2, FIND(" ", $H2) - 1))=0, VALUE(LEFT($I2, FIND(" ", $I2) - 1))=0, VALUE(LEFT($J2, FIND(" ", $J2) - 1))=0)'
+            'AND($A2 <> "", VALUE(LEFT($C2, FIND(" ",$C2)-1))=0, VALUE(LEFT($D2, FIND(" ", $D2) - 1)) = 0, VALUE(LEFT($E2, FIND(" ", $E2) - 1)) = 0, VALUE(LEFT($F2, FIND(" ", $F2)-1))=0, VALUE(LEFT($G2, FIND(" ", $G2) - 1))=0, VALUE(LEFT($H2, FIND(" ", $H2) - 1))=0, VALUE(LEFT($I2, FIND(" ", $I2) - 1))=0, VALUE(LEFT($J2, FIND(" ", $J2) - 1))=0, VALUE(LEFT($K2, FIND(" ", $K2) - 1))=0, VALUE(LEFT($L2, FIND(" ", $L2) - 1))=0)'
         ]
-        ws.conditional_formatting.add(f"A2:J{ws.max_row}", row_pass)
+        ws.conditional_formatting.add(f"A2:L{ws.max_row}", row_pass)
 
         def get_warning_rule():
             return Rule(
@@ -162,6 +162,14 @@ class KMPXlsxStyler(XlsxStyler):
         warning.formula = ['VALUE(LEFT($H2, FIND(" ", $H2) - 1)) <> 0']
         ws.conditional_formatting.add(f"H2:H{ws.max_row}", warning)
 
+        warning = get_warning_rule()
+        warning.formula = ['VALUE(LEFT($K2, FIND(" ", $K2) - 1)) <> 0']
+        ws.conditional_formatting.add(f"K2:K{ws.max_row}", warning)
+
+        warning = get_warning_rule()
+        warning.formula = ['VALUE(LEFT($L2, FIND(" ", $L2) - 1)) <> 0']
+        ws.conditional_formatting.add(f"L2:L{ws.max_row}", warning)
+
         def get_error_rule():
             return Rule(
                 type="expression",
@@ -197,6 +205,8 @@ class KMPXlsxStyler(XlsxStyler):
                 "H": 15,
                 "I": 15,
                 "J": 15,
+                "K": 15,
+                "L": 15,
             },
         )
 
@@ -7,6 +7,7 @@ from openpyxl.styles import (
 )
 from openpyxl import load_workbook
 import json
+import hashlib
 from .version import __VERSION__
 from datetime import datetime
 from copy import copy
@@ -54,6 +55,11 @@ class SDCConf:
     def get_valid_licenses(self):
         return self._conf["valid-licenses"]
 
+    def get_policy_digest(self):
+        """Digest of the settings the check results depend on."""
+        policy = json.dumps(self.get_valid_licenses(), sort_keys=True)
+        return hashlib.sha256(policy.encode()).hexdigest()
+
     def get_kmp_header(self):
         return self._get_xlsx_info("kmp", "xlsx", "table", "header")
 
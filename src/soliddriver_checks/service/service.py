@@ -2,19 +2,34 @@
 
 from threading import Lock, Thread
 from bottle import get, run, response
-from ..api.analysis import kms_to_json
+from ..api import results
+from ..api.cache import KMInfoCache
+from ..api.km import KMReader, KMAnalysis, KM_CHECKS
 from ..version import __VERSION__
+from .watch import SystemWatcher, RUNNING
 import os
 import json
 import logging
-from time import sleep
+from time import monotonic
 
 
 class KMInfo:
+    """The result of the checks of the modules of the system, updated when
+    they change.
+
+    Only the entries of the modules which changed are checked again, the
+    modules are read again only if their files changed, see KMInfoCache.
+    Every interval hours, the result is rebuilt from a full scan in case a
+    change was missed.
+    """
+
     def __init__(self, interval):
         self._data_lock = Lock()
         self._info = json.dumps([])
         self._interval = interval
+        # {filename: modinfo}, {filename: result} of the last update
+        self._kms = {}
+        self._records = {}
         t = Thread(target=self._async_refresh_data)
         t.start()
 
@@ -26,17 +41,62 @@ class KMInfo:
         return info
 
     def _async_refresh_data(self):
+        watcher = SystemWatcher()
         while True:
             self._refresh_data()
-            sleep(self._interval * 60 * 60)
+            resync = monotonic() + self._interval * 60 * 60
+            while True:
+                changes = watcher.wait(max(resync - monotonic(), 0))
+                if not changes:
+                    break
+                self._update_data(changes)
 
     def _refresh_data(self):
         logging.info("start to refresh data...")
-        new_data = kms_to_json()
-        with self._data_lock:
-            self._info = new_data
+        self._kms = {}
+        self._records = {}
+        kms = self._read_kms()
+        self._update_records(kms, list(kms))
         logging.info("data refreshing is completed!")
 
+    def _update_data(self, changes):
+        logging.info("%s changed, updating data..." % ", ".join(sorted(changes)))
+        changed = None
+        if changes == {RUNNING}:
+            kms = self._kms
+            changed = KMReader().update_running(kms)
+        if changed is None:
+            kms = self._read_kms()
+            changed = [f for f, info in kms.items() if self._kms.get(f, None) != info]
+        self._update_records(kms, changed)
+        logging.info("data updating is completed, %d module(s) changed" % len(changed))
+
+    def _read_kms(self):
+        # only the modules changed since the previous refresh are read.
+        cache = KMInfoCache()
+        try:
+            kms = KMReader(cache=cache).get_all_modinfo()
+        finally:
+            cache.close()
+        for info in kms.values():
+            # not needed for the checks, and not read back from the cache
+            info.pop("symbols", None)
+
+        return kms
+
+    def _update_records(self, kms, changed):
+        records = {f: r for f, r in self._records.items() if f in kms}
+        if len(changed) > 0:
+            df = KMAnalysis().kms_analysis({f: kms[f] for f in changed})
+            for record in results.to_nested_records(df, KM_CHECKS):
+                records[record["filename"]["value"]] = record
+        self._kms = kms
+        self._records = records
+
+        info = results.records_to_json([records[f] for f in sorted(records)])
+        with self._data_lock:
+            self._info = info
+
 
 def run_as_service(host="0.0.0.0", port=8080):
     logging.basicConfig(
@@ -46,7 +106,7 @@ def run_as_service(host="0.0.0.0", port=8080):
 
     interval = os.getenv("REFRESH_INTERVAL")
     interval = int(interval) if interval is not None else 1
-    logging.info("refresh interval: %s hour(s)" % interval)
+    logging.info("full refresh interval: %s hour(s)" % interval)
 
     global kms
     kms = KMInfo(interval)
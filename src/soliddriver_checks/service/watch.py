@@ -0,0 +1,151 @@
+import logging
+import os
+import select
+import time
+from ..api.cache import RPMDB_DIRS, rpmdb_stamp
+from ..api.utils.inotify import (
+    Inotify,
+    InotifyError,
+    IN_CREATE,
+    IN_IGNORED,
+    IN_ISDIR,
+    IN_MOVED_TO,
+    IN_Q_OVERFLOW,
+    add_tree_watches,
+)
+from ..api.utils.kmfile import loaded_modules
+
+# the kinds of changes reported by SystemWatcher.wait
+MODULES = "modules"
+RPMDB = "rpmdb"
+RUNNING = "running"
+
+# seconds without a new change before the changes are reported, a package
+# installation is a burst of events, and the longest they are held back.
+DEBOUNCE = 5
+MAX_DELAY = 60
+# seconds between two reads of /proc/modules and the rpm database stamp,
+# neither can be watched with inotify.
+POLL_INTERVAL = 2
+
+
+class SystemWatcher:
+    """Wait for the changes of the kernel modules of the system.
+
+    The module trees are watched with inotify, a watch per directory. The
+    modules loaded or unloaded and the packages installed or removed are
+    polled, from /proc/modules and the mtimes of the rpm database files.
+    Without inotify, or once fs.inotify.max_user_watches is reached, the
+    changes of the module trees are not seen and only the periodic full
+    refresh of the service finds them.
+    """
+
+    def __init__(
+        self,
+        modules_root="/lib/modules",
+        proc_modules="/proc/modules",
+        rpmdb_dirs=RPMDB_DIRS,
+        debounce=DEBOUNCE,
+        max_delay=MAX_DELAY,
+        poll_interval=POLL_INTERVAL,
+    ):
+        self._proc_modules = proc_modules
+        self._rpmdb_dirs = rpmdb_dirs
+        self._debounce = debounce
+        self._max_delay = max_delay
+        self._poll_interval = poll_interval
+
+        self._inotify = None
+        self._watches = {}
+        root = os.path.realpath(modules_root)
+        try:
+            self._inotify = Inotify()
+            self._watches = add_tree_watches(self._inotify, root)
+        except (InotifyError, OSError) as e:
+            logging.warning("Can't watch %s for changes: %s" % (root, e))
+            self.close()
+
+        self._running = self._loaded_modules()
+        self._rpmdb = rpmdb_stamp(self._rpmdb_dirs)
+
+    def _loaded_modules(self):
+        # only the names, the reference counts change all the time.
+        try:
+            return set(loaded_modules(self._proc_modules))
+        except OSError:
+            return None
+
+    def _poll(self):
+        changes = set()
+        running = self._loaded_modules()
+        if running != self._running:
+            self._running = running
+            changes.add(RUNNING)
+
+        stamp = rpmdb_stamp(self._rpmdb_dirs)
+        if stamp != self._rpmdb:
+            self._rpmdb = stamp
+            changes.add(RPMDB)
+
+        return changes
+
+    def _read_events(self):
+        changes = set()
+        for event in self._inotify.read():
+            if event.mask & IN_IGNORED:
+                self._watches.pop(event.wd, None)
+                continue
+            changes.add(MODULES)
+            if event.mask & IN_Q_OVERFLOW:
+                continue
+            parent = self._watches.get(event.wd, None)
+            new_dir = event.mask & (IN_CREATE | IN_MOVED_TO)
+            if event.mask & IN_ISDIR and new_dir and parent is not None:
+                path = os.path.join(parent, event.name)
+                try:
+                    self._watches.update(add_tree_watches(self._inotify, path))
+                except OSError as e:
+                    logging.warning("Can't watch %s for changes: %s" % (path, e))
+
+        return changes
+
+    def wait(self, timeout):
+        """Block until the system changes, at most timeout seconds.
+
+        Return the kinds of changes seen, MODULES, RPMDB and RUNNING, once
+        none came for debounce seconds, or an empty set on timeout.
+        """
+        now = time.monotonic()
+        deadline = now + timeout
+        changes = set()
+        first = last = None
+        while True:
+            if changes:
+                end = min(last + self._debounce, first + self._max_delay)
+            else:
+                end = deadline
+            if now >= end:
+                return changes
+
+            delay = min(end - now, self._poll_interval)
+            if self._inotify is None:
+                time.sleep(delay)
+                ready = False
+            else:
+                ready = select.select([self._inotify], [], [], delay)[0]
+
+            new = self._poll()
+            if ready:
+                new |= self._read_events()
+            now = time.monotonic()
+            if new:
+                if not changes:
+                    first = now
+                changes |= new
+                last = now
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+            self._watches = {}